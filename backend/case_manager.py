@@ -1,23 +1,220 @@
 """
 Doc Processing System using DocETL
 Handles case tracking, status updates, and data persistence
+
+Storage layout (one set of files per case in CASES_DIR):
+- {case_id}.json                    Small metadata (id, customer, status, timestamps, costs)
+- {case_id}.analysis.json           Original AI analysis
+- {case_id}.edits.json              Expert-edited analysis
+- {case_id}.comments.json           Expert comments
+- {case_id}.records.ndjson           Source records (provenance), one JSON object per line
+- .locks/{case_id}.lock             Lock file for metadata updates (see _case_write_lock)
+
+Keeping the heavy payloads out of the metadata file means status and cost
+updates only rewrite a few hundred bytes. Cases written before this layout
+keep their payloads inline; they are read as-is and moved out on first update.
 """
 
-import json
+import logging
 import os
-from copy import deepcopy
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
 
 CASES_DIR = os.path.join(os.path.dirname(__file__), "cases")
 
+# Case fields stored in JSON sidecar files rather than the metadata file
+BLOB_FIELDS = ("analysis", "edits", "comments")
+
+# Payloads that pre-sidecar cases may still carry inline in the metadata file
+INLINE_FIELDS = BLOB_FIELDS + ("original_records",)
+
+# Set once the cases directory is known to exist, so writers only pay for makedirs once per process
+_cases_dir_ready = False
+
+# Per-case lock files live in a subdirectory, so creating one doesn't touch the cases directory's
+# mtime (which list_cases() caches on)
+LOCKS_SUBDIR = ".locks"
+
+# Temp files older than this were left by a writer that died before renaming them into place
+STALE_TMP_SECONDS = 3600
+
 def ensure_cases_dir():
-    """Create cases directory if it doesn't exist"""
-    os.makedirs(CASES_DIR, exist_ok=True)
+    """
+    Create cases directory if it doesn't exist and clear out stale temp files
+    (checked once per process)
+    """
+    global _cases_dir_ready
+    if not _cases_dir_ready:
+        os.makedirs(os.path.join(CASES_DIR, LOCKS_SUBDIR), exist_ok=True)
+        _remove_stale_tmp_files()
+        _cases_dir_ready = True
+
+def _remove_stale_tmp_files():
+    """Delete temp files abandoned by interrupted atomic writes"""
+    cutoff = datetime.now().timestamp() - STALE_TMP_SECONDS
+    with os.scandir(CASES_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".tmp") and entry.stat().st_mtime < cutoff:
+                try:
+                    os.unlink(entry.path)
+                    logger.info("[Case Manager] Removed stale temp file %s", entry.name)
+                except FileNotFoundError:
+                    pass  # Another worker got to it first
+
+# Valid case statuses and the metadata field stamped when a case enters each one
+_STATUS_TIMESTAMP_KEYS = {
+    "processing": "processing_at",
+    "pending_review": "pending_review_at",
+    "approved": "approved_at",
+    "delivered": "delivered_at",
+}
+
+# Parsed case cache: case_id -> (metadata file mtime_ns/inode, case dict), least recently used evicted first.
+# Every write rewrites the metadata file last, so its stat identifies the whole case version.
+CASE_CACHE_SIZE = 128
+_case_cache = OrderedDict()
+_case_cache_lock = threading.Lock()  # Readers and writers run on different threadpool threads
+
+# Cached list_cases() result: (cases dir mtime_ns, sorted case list)
+_case_list_cache = None
+
+# Parses metadata files in parallel for list_cases() (threads are started lazily)
+_list_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="case-list")
+
+def _invalidate_case(case_id: str):
+    """Drop cached copies of a case before it is rewritten"""
+    global _case_list_cache
+    with _case_cache_lock:
+        _case_cache.pop(case_id, None)
+    _case_list_cache = None
+
+def _meta_path(case_id: str) -> str:
+    return os.path.join(CASES_DIR, f"{case_id}.json")
+
+def _blob_path(case_id: str, field: str) -> str:
+    return os.path.join(CASES_DIR, f"{case_id}.{field}.json")
+
+def _records_path(case_id: str) -> str:
+    return os.path.join(CASES_DIR, f"{case_id}.records.ndjson")
+
+def _lock_path(case_id: str) -> str:
+    return os.path.join(CASES_DIR, LOCKS_SUBDIR, f"{case_id}.lock")
+
+def _is_meta_file(filename: str) -> bool:
+    """Metadata files are {case_id}.json; sidecars carry an extra dotted suffix"""
+    return filename.endswith(".json") and filename.count(".") == 1
+
+def _read_json(path: str):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+@contextmanager
+def _atomic_open(path: str):
+    """
+    Open a temp file in CASES_DIR for binary writing and rename it over path on success.
+    Readers never see a partially written file, and a crash mid-write leaves the previous
+    version in place (plus a .tmp file that ensure_cases_dir() cleans up later).
+    """
+    ensure_cases_dir()
+    fd, tmp_path = tempfile.mkstemp(dir=CASES_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+@contextmanager
+def _case_write_lock(case_id: str):
+    """
+    Hold an exclusive advisory lock on one case for its metadata read-modify-write, so updates
+    from other threads or server worker processes aren't lost in between. Only the small metadata
+    cycle runs under it: sidecars are written before taking it. Files are still replaced
+    atomically; readers never need the lock.
+    """
+    ensure_cases_dir()
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(_lock_path(case_id), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # Releases the lock
+
+def _write_bytes(path: str, data: bytes):
+    """Write a file atomically"""
+    with _atomic_open(path) as f:
+        f.write(data)
+
+def _write_json(path: str, obj):
+    _write_bytes(path, orjson.dumps(obj))
+
+def _write_records(case_id: str, records: List[Dict]):
+    """Write source records as NDJSON, one serialized record at a time"""
+    with _atomic_open(_records_path(case_id)) as f:
+        for record in records:
+            f.write(orjson.dumps(record))
+            f.write(b"\n")
+
+def _read_listing_meta(path: str) -> Dict:
+    """Read a metadata file for list_cases(), dropping inline payloads of pre-sidecar cases"""
+    meta = _read_json(path)
+    for field in INLINE_FIELDS:
+        meta.pop(field, None)
+    return meta
+
+def _read_meta_for_update(case_id: str, replaced=()) -> Dict:
+    """
+    Load a case's metadata for modification.
+    Payloads still stored inline (pre-sidecar cases) are moved out to sidecar files first,
+    except fields in replaced: the caller has already written their new sidecar, so the
+    inline copy is just dropped.
 
-def generate_case_id():
-    """Generate a simple timestamp-based case ID"""
-    return datetime.now().strftime("%Y%m%d_%H%M%S")
+    Raises:
+        FileNotFoundError: If the case does not exist
+    """
+    meta = _read_json(_meta_path(case_id))
+    for field in BLOB_FIELDS:
+        if field in meta:
+            value = meta.pop(field)
+            if field not in replaced:
+                _write_json(_blob_path(case_id, field), value)
+    if "original_records" in meta:
+        records = meta.pop("original_records")
+        if "original_records" not in replaced:
+            _write_records(case_id, records)
+    return meta
+
+def _now_iso() -> str:
+    return datetime.now().isoformat()
+
+def generate_case_id(now: datetime = None):
+    """
+    Generate a timestamp-based case ID with a random suffix, e.g. 20260103_103552_9f1c2a
+
+    The %Y%m%d_%H%M%S prefix keeps IDs sortable by creation time (list_cases relies on this);
+    the suffix keeps cases created within the same second from overwriting each other.
+    """
+    now = now or datetime.now()
+    return f"{now:%Y%m%d_%H%M%S}_{secrets.token_hex(3)}"
 
 def create_case(customer_name: str, customer_email: str, pipeline: str, records_count: int) -> str:
     """
@@ -32,25 +229,23 @@ def create_case(customer_name: str, customer_email: str, pipeline: str, records_
     Returns:
         Case ID
     """
-    ensure_cases_dir()
-
-    case_id = generate_case_id()
+    now = datetime.now()
+    case_id = generate_case_id(now)
     case = {
         "id": case_id,
         "customer_name": customer_name,
         "customer_email": customer_email,
         "pipeline": pipeline,
         "records_count": records_count,
-        "uploaded_at": datetime.now().isoformat(),
+        "uploaded_at": now.isoformat(),
         "status": "processing",  # processing, pending_review, approved, delivered
         "estimated_cost_per_page": 0.15
     }
 
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
-    with open(case_path, "w") as f:
-        json.dump(case, f, indent=2)
+    _invalidate_case(case_id)
+    _write_json(_meta_path(case_id), case)
 
-    print(f"[Case Manager] Created case {case_id} for {customer_name}")
+    logger.info("[Case Manager] Created case %s for %s", case_id, customer_name)
     return case_id
 
 def update_case_analysis(case_id: str, analysis: Dict, original_records: List[Dict] = None):
@@ -62,71 +257,196 @@ def update_case_analysis(case_id: str, analysis: Dict, original_records: List[Di
         analysis: Analysis results dict
         original_records: Optional list of original source records (for provenance tracking)
     """
-    ensure_cases_dir()
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
-
-    if not os.path.exists(case_path):
-        print(f"[Case Manager] Warning: Case {case_id} not found")
+    if not os.path.exists(_meta_path(case_id)):
+        logger.warning("[Case Manager] Warning: Case %s not found", case_id)
         return
 
-    with open(case_path, "r") as f:
-        case = json.load(f)
-
-    case["analysis"] = analysis
-    case["status"] = "pending_review"
-    case["analyzed_at"] = datetime.now().isoformat()
+    # Sidecars are written before taking the case lock, which only covers the metadata cycle below
+    _invalidate_case(case_id)
 
-    # Initialize edits as deep copy of analysis (user can modify without affecting original)
-    case["edits"] = deepcopy(analysis)
+    # Initialize edits as a copy of analysis (user can modify without affecting original).
+    # Write the same bytes to both files; no in-memory copy is needed.
+    analysis_bytes = orjson.dumps(analysis)
+    _write_bytes(_blob_path(case_id, "analysis"), analysis_bytes)
+    _write_bytes(_blob_path(case_id, "edits"), analysis_bytes)
+    replaced = ("analysis", "edits")
 
     # Store original records for provenance tracking (view source feature)
     if original_records is not None:
-        case["original_records"] = original_records
-        print(f"[Case Manager] Stored {len(original_records)} original source records")
+        _write_records(case_id, original_records)
+        replaced += ("original_records",)
+        logger.info("[Case Manager] Stored %s original source records", len(original_records))
+
+    with _case_write_lock(case_id):
+        try:
+            meta = _read_meta_for_update(case_id, replaced)
+        except FileNotFoundError:
+            logger.warning("[Case Manager] Warning: Case %s not found", case_id)
+            return
 
-    with open(case_path, "w") as f:
-        json.dump(case, f, indent=2)
+        _invalidate_case(case_id)
+        meta["status"] = "pending_review"
+        meta["analyzed_at"] = _now_iso()
+        _write_json(_meta_path(case_id), meta)
 
-    print(f"[Case Manager] Updated case {case_id} with analysis results")
+    logger.info("[Case Manager] Updated case %s with analysis results", case_id)
 
-def get_case(case_id: str) -> Optional[Dict]:
+def get_case(case_id: str, include_records: bool = True) -> Optional[Dict]:
     """
-    Get case by ID
+    Get case by ID, including analysis, edits, comments and (optionally) original records
 
     Args:
         case_id: Case ID
+        include_records: Attach original_records. Callers that only need the analysis
+            should pass False to skip reading the records file.
 
     Returns:
-        Case dict or None if not found
+        Case dict or None if not found. Treat it as read-only; without records it is
+        shared with the cache.
     """
-    ensure_cases_dir()
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
+    case = _get_cached_case(case_id)
+    if case is None:
+        return None
+    if not include_records:
+        return case
+
+    records = get_case_records(case_id)
+    if records is None:
+        return case
+    return {**case, "original_records": records}
+
+def _get_cached_case(case_id: str) -> Optional[Dict]:
+    """Load a case's metadata and JSON sidecars, without original records"""
+    meta_path = _meta_path(case_id)
+
+    try:
+        st = os.stat(meta_path)
+        version = (st.st_mtime_ns, st.st_ino)
+        with _case_cache_lock:
+            cached = _case_cache.get(case_id)
+            if cached is not None and cached[0] == version:
+                _case_cache.move_to_end(case_id)
+                return cached[1]
+
+        case = _read_json(meta_path)
+    except FileNotFoundError:
+        return None
+
+    for field in BLOB_FIELDS:
+        try:
+            case[field] = _read_json(_blob_path(case_id, field))
+        except FileNotFoundError:
+            pass  # Not written yet, or still inline in a pre-sidecar case
+
+    # Pre-sidecar cases keep records inline; get_case_records() reads them from there
+    case.pop("original_records", None)
+
+    with _case_cache_lock:
+        _case_cache[case_id] = (version, case)
+        if len(_case_cache) > CASE_CACHE_SIZE:
+            _case_cache.popitem(last=False)
+
+    return case
+
+def iter_case_records(case_id: str) -> Iterator[Dict]:
+    """
+    Yield a case's original source records one at a time, without loading the whole file
+
+    Args:
+        case_id: Case ID
 
-    if not os.path.exists(case_path):
+    Raises:
+        FileNotFoundError: If no records file exists for the case
+    """
+    with open(_records_path(case_id), "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+def get_case_records(case_id: str) -> Optional[List[Dict]]:
+    """
+    Get the original source records stored with a case (for provenance / view source)
+
+    Args:
+        case_id: Case ID
+
+    Returns:
+        List of records, or None if the case or its records don't exist
+    """
+    try:
+        return list(iter_case_records(case_id))
+    except FileNotFoundError:
+        pass
+
+    # Pre-sidecar case: records are still inline in the metadata file
+    try:
+        return _read_json(_meta_path(case_id)).get("original_records")
+    except FileNotFoundError:
         return None
 
-    with open(case_path, "r") as f:
-        return json.load(f)
+def get_case_records_json(case_id: str) -> Optional[bytes]:
+    """
+    Get a case's original source records as a JSON array, spliced from the records file
+    without parsing it. For API responses: wrap in orjson.Fragment to embed it as-is.
+
+    Args:
+        case_id: Case ID
+
+    Returns:
+        JSON array bytes, or None if the case or its records don't exist
+    """
+    try:
+        with open(_records_path(case_id), "rb") as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        # Pre-sidecar case: records are still inline in the metadata file
+        records = get_case_records(case_id)
+        return None if records is None else orjson.dumps(records)
+    return b"[" + b",".join(line for line in lines if line) + b"]"
+
+def pretty_export_case(case_id: str) -> Optional[str]:
+    """
+    Render a full case (metadata plus all sidecars) as indented JSON for manual inspection.
+    Case files on disk are written compact; use this instead of reading them by hand.
+
+    Args:
+        case_id: Case ID
+
+    Returns:
+        Indented JSON string or None if not found
+    """
+    case = get_case(case_id)
+    if case is None:
+        return None
+    return orjson.dumps(case, option=orjson.OPT_INDENT_2).decode()
 
 def list_cases() -> List[Dict]:
     """
     List all cases, sorted by upload date (newest first)
 
+    Only metadata is returned; use get_case() for analysis, edits, comments and records.
+
     Returns:
-        List of case dicts
+        List of case metadata dicts (shared with the cache, so treat as read-only)
     """
-    ensure_cases_dir()
+    global _case_list_cache
+
+    try:
+        dir_mtime_ns = os.stat(CASES_DIR).st_mtime_ns
+        if _case_list_cache is not None and _case_list_cache[0] == dir_mtime_ns:
+            return _case_list_cache[1]
 
-    cases = []
-    for filename in os.listdir(CASES_DIR):
-        if filename.endswith(".json"):
-            case_path = os.path.join(CASES_DIR, filename)
-            with open(case_path, "r") as f:
-                cases.append(json.load(f))
+        with os.scandir(CASES_DIR) as it:
+            paths = [entry.path for entry in it if _is_meta_file(entry.name)]
+    except FileNotFoundError:
+        return []
 
-    # Sort by uploaded_at (newest first)
-    cases.sort(key=lambda x: x.get("uploaded_at", ""), reverse=True)
+    # Case IDs start with the %Y%m%d_%H%M%S upload timestamp, so sorting by filename is
+    # newest-first without looking inside the files
+    paths.sort(reverse=True)
+    cases = list(_list_pool.map(_read_listing_meta, paths))
 
+    _case_list_cache = (dir_mtime_ns, cases)
     return cases
 
 def update_case_edits(case_id: str, edits: Dict, comments: Dict = None):
@@ -138,28 +458,33 @@ def update_case_edits(case_id: str, edits: Dict, comments: Dict = None):
         edits: Edited analysis dict (same structure as analysis)
         comments: Expert comments dict (optional)
     """
-    ensure_cases_dir()
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
-
-    if not os.path.exists(case_path):
-        print(f"[Case Manager] Warning: Case {case_id} not found")
+    if not os.path.exists(_meta_path(case_id)):
+        logger.warning("[Case Manager] Warning: Case %s not found", case_id)
         return
 
-    with open(case_path, "r") as f:
-        case = json.load(f)
-
-    case["edits"] = edits
-    case["last_edited"] = datetime.now().isoformat()
+    # Sidecars are written before taking the case lock, which only covers the metadata cycle below
+    _invalidate_case(case_id)
+    _write_json(_blob_path(case_id, "edits"), edits)
+    replaced = ("edits",)
 
     # Save comments if provided
     if comments is not None:
-        case["comments"] = comments
-        print(f"[Case Manager] Updated comments for case {case_id}")
+        _write_json(_blob_path(case_id, "comments"), comments)
+        replaced += ("comments",)
+        logger.info("[Case Manager] Updated comments for case %s", case_id)
 
-    with open(case_path, "w") as f:
-        json.dump(case, f, indent=2)
+    with _case_write_lock(case_id):
+        try:
+            meta = _read_meta_for_update(case_id, replaced)
+        except FileNotFoundError:
+            logger.warning("[Case Manager] Warning: Case %s not found", case_id)
+            return
 
-    print(f"[Case Manager] Updated edits for case {case_id}")
+        _invalidate_case(case_id)
+        meta["last_edited"] = _now_iso()
+        _write_json(_meta_path(case_id), meta)
+
+    logger.info("[Case Manager] Updated edits for case %s", case_id)
 
 def update_case_status(case_id: str, status: str):
     """
@@ -168,24 +493,27 @@ def update_case_status(case_id: str, status: str):
     Args:
         case_id: Case ID
         status: New status (processing, pending_review, approved, delivered)
-    """
-    ensure_cases_dir()
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
-
-    if not os.path.exists(case_path):
-        print(f"[Case Manager] Warning: Case {case_id} not found")
-        return
 
-    with open(case_path, "r") as f:
-        case = json.load(f)
+    Raises:
+        ValueError: If status is not one of the above
+    """
+    timestamp_key = _STATUS_TIMESTAMP_KEYS.get(status)
+    if timestamp_key is None:
+        raise ValueError(f"Unknown case status: {status}")
 
-    case["status"] = status
-    case[f"{status}_at"] = datetime.now().isoformat()
+    with _case_write_lock(case_id):
+        try:
+            meta = _read_meta_for_update(case_id)
+        except FileNotFoundError:
+            logger.warning("[Case Manager] Warning: Case %s not found", case_id)
+            return
 
-    with open(case_path, "w") as f:
-        json.dump(case, f, indent=2)
+        meta["status"] = status
+        meta[timestamp_key] = _now_iso()
+        _invalidate_case(case_id)
+        _write_json(_meta_path(case_id), meta)
 
-    print(f"[Case Manager] Updated case {case_id} status to {status}")
+    logger.info("[Case Manager] Updated case %s status to %s", case_id, status)
 
 def update_case_costs(case_id: str, cost_data: Dict):
     """
@@ -195,31 +523,28 @@ def update_case_costs(case_id: str, cost_data: Dict):
         case_id: Case ID
         cost_data: Dict with extraction_cost, analysis_cost, total_cost, total_tokens, etc.
     """
-    ensure_cases_dir()
-    case_path = os.path.join(CASES_DIR, f"{case_id}.json")
-
-    if not os.path.exists(case_path):
-        print(f"[Case Manager] Warning: Case {case_id} not found")
-        return
-
     # Skip saving if all costs are zero (no LLM calls were made, likely cache hit)
     if cost_data.get("total_cost", 0) == 0:
-        print(f"[Case Manager] No costs to track for case {case_id} (likely cache hit)")
+        logger.info("[Case Manager] No costs to track for case %s (likely cache hit)", case_id)
         return
 
-    with open(case_path, "r") as f:
-        case = json.load(f)
+    with _case_write_lock(case_id):
+        try:
+            meta = _read_meta_for_update(case_id)
+        except FileNotFoundError:
+            logger.warning("[Case Manager] Warning: Case %s not found", case_id)
+            return
 
-    # Calculate cost per page
-    records_count = case.get("records_count", cost_data.get("records_processed", 0))
-    cost_per_page = cost_data["total_cost"] / records_count if records_count > 0 else 0
+        # Calculate cost per page
+        records_count = meta.get("records_count") or cost_data.get("records_processed", 0)
+        cost_per_page = cost_data["total_cost"] / records_count if records_count > 0 else 0
 
-    # Update case with actual costs
-    case["actual_cost"] = cost_data["total_cost"]
-    case["cost_per_page"] = cost_per_page
-    case["cost_breakdown"] = cost_data
+        # Update case with actual costs
+        meta["actual_cost"] = cost_data["total_cost"]
+        meta["cost_per_page"] = cost_per_page
+        meta["cost_breakdown"] = cost_data
 
-    with open(case_path, "w") as f:
-        json.dump(case, f, indent=2)
+        _invalidate_case(case_id)
+        _write_json(_meta_path(case_id), meta)
 
-    print(f"[Case Manager] Updated costs for case {case_id}: ${cost_data['total_cost']:.4f} (${cost_per_page:.4f}/page)")
+    logger.info("[Case Manager] Updated costs for case %s: $%.4f ($%.4f/page)", case_id, cost_data['total_cost'], cost_per_page)
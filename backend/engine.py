@@ -1,63 +1,1074 @@
 import os
-import json
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+import uuid
+import orjson
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 from docetl import DSLRunner
 from dotenv import load_dotenv
 from pipeline_configs import get_pipeline_config
 from litellm import completion_cost
+from litellm.cost_calculator import batch_cost_calculator
 import litellm
 import threading
-from jinja2 import Template
+from jinja2 import Environment, Template, nodes
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 litellm.request_timeout = 300
 
 # ============= LiteLLM Cost Tracking =============
-# Thread-safe cost tracker for capturing actual LLM usage
+# Usage and cost of every LLM call, recorded per pipeline run: runs overlap on the API server's
+# threadpool, so each run drains only the calls it made (chat calls belong to no run). Calls are
+# recorded where they return, not from a LiteLLM success callback: those run later on LiteLLM's
+# logging thread for sync calls, and aren't invoked at all for plain-function callbacks on async
+# calls, so a run draining right after its last call would miss some. DocETL's extraction calls
+# are counted from its runner's totals. Calls also carry the run in metadata={"operation": ...,
+# "run_id": ...} for LiteLLM's own logging.
 _cost_tracker = {
-    "calls": [],
-    "lock": threading.Lock(),
-    "operation_context": None  # Track which operation (extraction/analysis) is running
+    "lock": threading.Lock(),  # Guards registering and draining runs; appends don't need it
+    "runs": {}  # run_id -> list of recorded calls
 }
 
-def track_llm_costs(kwargs, response_obj, start_time, end_time):
+def start_cost_run():
+    """Register a new pipeline run with the cost tracker and return its run_id"""
+    run_id = uuid.uuid4().hex
+    with _cost_tracker["lock"]:
+        _cost_tracker["runs"][run_id] = []
+    return run_id
+
+def llm_call_metadata(run_id, operation):
+    """LiteLLM metadata tagging a call with its run and operation ("extraction"/"analysis")"""
+    return {"operation": operation, "run_id": run_id}
+
+def record_llm_usage(run_id, operation, model, usage, cost):
+    """Add one call's token usage (a dict of *_tokens counts) and cost to its run, if it's tracked"""
+    calls = _cost_tracker["runs"].get(run_id)
+    if calls is None:
+        return
+    # list.append is atomic; a run's calls come from its own worker threads
+    calls.append({
+        "model": model,
+        "prompt_tokens": usage.get("prompt_tokens", 0) or 0,
+        "completion_tokens": usage.get("completion_tokens", 0) or 0,
+        "total_tokens": usage.get("total_tokens", 0) or 0,
+        "cost": cost,
+        "operation": operation
+    })
+
+def record_llm_call(run_id, operation, model, response):
+    """Record a LiteLLM completion response's usage and cost (computed by LiteLLM) for a run"""
+    if run_id is None:
+        return
+    try:
+        usage = response.get("usage") or {}
+        try:
+            cost = completion_cost(completion_response=response)
+        except Exception as e:
+            _warn_unpriced_model(model, str(e))
+            cost = 0.0
+        record_llm_usage(run_id, operation, model, usage, cost)
+    except Exception as e:
+        logger.error("[Cost Tracking] Error recording call: %s", e)
+
+def drain_cost_calls(run_id):
+    """Remove a run from the tracker and return every call recorded for it"""
+    with _cost_tracker["lock"]:
+        return _cost_tracker["runs"].pop(run_id, [])
+
+@lru_cache(maxsize=None)
+def _warn_unpriced_model(model, error):
+    """Warn once per model that LiteLLM has no price for it (e.g. a self-hosted model, counted as free)"""
+    logger.warning("[Cost Tracking] Warning: Could not calculate cost for %s, counting it as $0: %s", model, error)
+
+# ============= END Cost Tracking =============
+
+# Every analysis returned by run_forensic_pipeline() has exactly these keys, in this order
+ANALYSIS_OUTPUT_KEYS = ("chronology", "missing_records", "red_flags", "contradictions", "expert_opinions_needed")
+
+def empty_analysis(**fields):
+    """Return a fresh analysis dict with every output key set to an empty list, overridden by fields"""
+    analysis = {key: [] for key in ANALYSIS_OUTPUT_KEYS}
+    analysis.update(fields)
+    return analysis
+
+# ============= Pipeline Result Cache =============
+# Finished analyses keyed by a hash of (pipeline config, extraction backend and endpoint, analysis model,
+# input records), so re-running identical inputs skips every LLM call. Entries hold full analyses of
+# patient records, so the cache is opt-in (PIPELINE_CACHE=1) and entries expire after
+# PIPELINE_CACHE_TTL seconds; the oldest are dropped beyond PIPELINE_CACHE_MAX_ENTRIES.
+PIPELINE_CACHE_DIR = os.path.join(os.path.dirname(__file__), "pipeline_cache")
+PIPELINE_CACHE_ENABLED = os.getenv("PIPELINE_CACHE", "0") == "1"
+PIPELINE_CACHE_TTL = int(os.getenv("PIPELINE_CACHE_TTL", str(7 * 24 * 3600)))
+PIPELINE_CACHE_MAX_ENTRIES = int(os.getenv("PIPELINE_CACHE_MAX_ENTRIES", "500"))
+
+@lru_cache(maxsize=None)
+def pipeline_fingerprint(pipeline):
     """
-    Callback to capture actual token usage and costs from LiteLLM calls made by DocETL.
-    Automatically invoked by LiteLLM on each successful completion.
+    Hash of a pipeline's static configuration (prompts, schemas, models).
+    Pipeline configs don't change at runtime, so this is computed once per pipeline.
     """
+    config_bytes = orjson.dumps(get_pipeline_config(pipeline), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(config_bytes, digest_size=16).hexdigest()
+
+def pipeline_cache_key(input_data, pipeline, analysis_model, extraction_backend, completion_kwargs):
+    """Content hash identifying a pipeline run (BLAKE2b: fast on large record payloads)"""
+    payload = orjson.dumps(
+        [pipeline_fingerprint(pipeline), extraction_backend, cache_key_kwargs(completion_kwargs), analysis_model, input_data],
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def load_cached_analysis(cache_key, max_age_seconds=PIPELINE_CACHE_TTL):
+    """Return the cached analysis for a run, or None on a miss (or if older than max_age_seconds)"""
+    cache_path = os.path.join(PIPELINE_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(cache_path, "rb") as f:
+            if time.time() - os.fstat(f.fileno()).st_mtime <= max_age_seconds:
+                return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+    # Expired
+    try:
+        os.unlink(cache_path)
+    except FileNotFoundError:
+        pass  # Removed by another run
+    return None
+
+def _prune_pipeline_cache():
+    """Delete expired analyses, then the oldest ones beyond PIPELINE_CACHE_MAX_ENTRIES"""
+    now = time.time()
+    entries = []
+    with os.scandir(PIPELINE_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+    entries.sort(reverse=True)
+    for i, (mtime, path) in enumerate(entries):
+        max_age = ANALYSIS_CACHE_TTL if os.path.basename(path).startswith("analysis-") else PIPELINE_CACHE_TTL
+        if i >= PIPELINE_CACHE_MAX_ENTRIES or now - mtime > max_age:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def save_cached_analysis(cache_key, analysis):
+    """Store a finished analysis (written to a temp file first so readers never see a partial entry)"""
+    try:
+        os.makedirs(PIPELINE_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(PIPELINE_CACHE_DIR, f"{cache_key}.json")
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(analysis))
+        os.replace(tmp_path, cache_path)
+        _prune_pipeline_cache()
+    except OSError as e:
+        logger.warning("[Pipeline] Warning: Could not write pipeline cache entry: %s", e)
+
+# The LLM analysis step is cached on its own, keyed by everything that shapes its prompt and output,
+# so identical extracted records skip the analysis call even when the run as a whole isn't cached
+ANALYSIS_TEMPERATURE = 0.1  # Low temperature for consistency
+ANALYSIS_CACHE_MAX_TEMPERATURE = 0.2  # Above this, repeat calls are expected to differ; don't cache
+ANALYSIS_CACHE_TTL = 24 * 3600
+
+def analysis_cache_key(sorted_records, analysis_model, pipeline_config):
+    """Content hash identifying an LLM analysis call"""
+    payload = orjson.dumps([
+        analysis_model,
+        ANALYSIS_TEMPERATURE,
+        pipeline_config.get("persona"),
+        pipeline_config.get("dataset_description"),
+        pipeline_config.get("analysis_prompt"),
+        pipeline_config.get("analysis_schema"),
+        sorted_records
+    ], option=orjson.OPT_SORT_KEYS)
+    return "analysis-" + hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+# Direct-extraction replies are cached per LLM call in SQLite, keyed by everything sent to the model,
+# so records that were already extracted skip their API call even when the run as a whole misses the
+# cache above. Opt in with ENABLE_LLM_CACHE=1. (DocETL keeps its own LLM call cache in ~/.cache/docetl.)
+LLM_CACHE_ENABLED = os.getenv("ENABLE_LLM_CACHE", "0") == "1"
+LLM_CACHE_PATH = os.path.join(PIPELINE_CACHE_DIR, "llm_responses.sqlite3")
+_llm_cache = {"lock": threading.Lock(), "db": None}
+# Extraction results are written as they complete, this many at a time, so an interrupted run
+# resumes from the cache instead of starting over
+LLM_CACHE_CHECKPOINT_SIZE = 50
+
+def _llm_cache_db():
+    """Open (creating if needed) the LLM response cache database; call with the lock held"""
+    if _llm_cache["db"] is None:
+        os.makedirs(PIPELINE_CACHE_DIR, exist_ok=True)
+        db = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS cache_entries (key BLOB PRIMARY KEY, response BLOB NOT NULL)")
+        _llm_cache["db"] = db
+    return _llm_cache["db"]
+
+def llm_cache_key(model, messages, response_format, validation_rules, completion_kwargs=None):
+    """Content hash identifying an LLM call and the rules its reply had to pass"""
+    payload = orjson.dumps([model, messages, response_format, validation_rules, cache_key_kwargs(completion_kwargs)],
+                           option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+def load_cached_responses(cache_keys):
+    """Return {cache key: cached output} for the keys found in the LLM response cache"""
+    found = {}
+    try:
+        with _llm_cache["lock"]:
+            db = _llm_cache_db()
+            for start in range(0, len(cache_keys), 500):
+                batch = cache_keys[start:start + 500]
+                rows = db.execute(
+                    f"SELECT key, response FROM cache_entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                )
+                found.update((key, orjson.loads(response)) for key, response in rows)
+    except sqlite3.Error as e:
+        logger.warning("[Cache] Warning: Could not read LLM response cache: %s", e)
+    return found
+
+def save_cached_responses(entries):
+    """Store (cache key, output) pairs in the LLM response cache in one transaction"""
+    try:
+        with _llm_cache["lock"]:
+            db = _llm_cache_db()
+            with db:
+                db.executemany(
+                    "INSERT OR IGNORE INTO cache_entries (key, response) VALUES (?, ?)",
+                    [(key, orjson.dumps(output)) for key, output in entries]
+                )
+    except sqlite3.Error as e:
+        logger.warning("[Cache] Warning: Could not write LLM response cache: %s", e)
+# ============= END Pipeline Result Cache =============
+
+@lru_cache(maxsize=None)
+def compile_template(source):
+    """Compile a Jinja prompt template once per distinct template source"""
+    return Template(source)
+
+# ============= Direct Extraction =============
+# Alternative to DocETL's map operation: records are sent concurrently through litellm.acompletion with
+# a strict JSON schema built from output_schema, and records that error or fail validation are retried.
+# Choose per pipeline with "extraction_backend": "litellm" in pipeline_configs.py, or for all pipelines
+# with EXTRACTION_BACKEND.
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "docetl")
+
+# OpenAI-compatible server for the extraction model, e.g. a self-hosted vLLM ("http://vllm:8000/v1")
+# with "extraction_model": "openai/<served model name>". Set per pipeline with "extraction_api_base";
+# both backends send the strict output schema, which vLLM enforces with guided decoding.
+EXTRACTION_API_BASE = os.getenv("EXTRACTION_API_BASE")
+# Key for that server. Without an explicit key LiteLLM would fall back to OPENAI_API_KEY and send the
+# real OpenAI key to the self-hosted host, so a placeholder is sent when this is unset.
+EXTRACTION_API_KEY = os.getenv("EXTRACTION_API_KEY")
+EXTRACTION_API_KEY_PLACEHOLDER = "EMPTY"
+
+def extraction_completion_kwargs(pipeline_config):
+    """Extra LiteLLM arguments for extraction calls (api_base and api_key for a self-hosted extraction model)"""
+    api_base = pipeline_config.get("extraction_api_base", EXTRACTION_API_BASE)
+    if not api_base:
+        return {}
+    return {"api_base": api_base, "api_key": EXTRACTION_API_KEY or EXTRACTION_API_KEY_PLACEHOLDER}
+
+def cache_key_kwargs(completion_kwargs):
+    """Completion kwargs that identify a call's results in cache keys (the endpoint, not its credentials)"""
+    return {key: value for key, value in (completion_kwargs or {}).items() if key != "api_key"}
+
+# Records are binned by estimated prompt size so short records don't queue behind long ones; bins run
+# side by side. Each bin: (max estimated tokens or None, concurrent requests, request timeout in seconds)
+# EXTRACTION_MAX_IN_FLIGHT caps requests across all bins; tune it to the provider's rate limits.
+EXTRACTION_MAX_IN_FLIGHT = int(os.getenv("EXTRACTION_MAX_IN_FLIGHT", "32"))
+EXTRACTION_BINS = (
+    (1_000, 32, 60),
+    (4_000, 16, 120),
+    (16_000, 8, 300),
+    (None, 4, 600),
+)
+
+# EXTRACTION_MAX_IN_FLIGHT is the ceiling of an AIMD window: every throttled call (429/503) halves the
+# window, at most once per round of calls, and waits out Retry-After; every successful call grows it by
+# 1/window. After EXTRACTION_BREAKER_THRESHOLD provider failures in a row (429, 5xx, timeouts; calls sent
+# before the last decrease don't count) the breaker opens: for EXTRACTION_BREAKER_SECONDS calls fail
+# fast without a request, and retries wait for it to close.
+EXTRACTION_BREAKER_THRESHOLD = 5
+EXTRACTION_BREAKER_SECONDS = 30
+THROTTLE_STATUS_CODES = (429, 503)
+PROVIDER_ERROR_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER_SECONDS = 60
+
+def new_call_window(max_in_flight):
+    """AIMD concurrency window and circuit breaker state for one extraction run's event loop"""
+    return {
+        "window": float(max_in_flight),
+        "max": max_in_flight,
+        "in_flight": 0,
+        "condition": asyncio.Condition(),
+        "decreased_at": 0.0,  # Calls started before the last decrease don't decrease it again
+        "consecutive_failures": 0,
+        "open_until": 0.0
+    }
+
+async def _acquire_call_slot(call_window):
+    async with call_window["condition"]:
+        await call_window["condition"].wait_for(lambda: call_window["in_flight"] < int(call_window["window"]))
+        call_window["in_flight"] += 1
+
+async def _release_call_slot(call_window):
+    async with call_window["condition"]:
+        call_window["in_flight"] -= 1
+        call_window["condition"].notify_all()
+
+def _retry_after_seconds(error):
+    """Retry-After of a throttled call, in seconds (capped), or None"""
+    headers = getattr(error, "litellm_response_headers", None) or getattr(getattr(error, "response", None), "headers", None)
     try:
-        model = kwargs.get("model", "unknown")
-        usage = response_obj.get("usage", {})
-        prompt_tokens = usage.get("prompt_tokens", 0)
-        completion_tokens = usage.get("completion_tokens", 0)
-        total_tokens = usage.get("total_tokens", 0)
+        return min(float(headers.get("retry-after") or headers.get("Retry-After")), MAX_RETRY_AFTER_SECONDS)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _record_call_outcome(call_window, response, started):
+    """Grow or shrink the window after a call, and open the breaker after repeated provider failures"""
+    if not isinstance(response, Exception):
+        call_window["window"] = min(call_window["max"], call_window["window"] + 1 / call_window["window"])
+        call_window["consecutive_failures"] = 0
+        return
+    if started < call_window["decreased_at"]:
+        # Sent before the last decrease: the window already reacted to this round of failures
+        return
+    status_code = getattr(response, "status_code", None)
+    if status_code in THROTTLE_STATUS_CODES:
+        previous = int(call_window["window"])
+        call_window["window"] = max(1.0, call_window["window"] / 2)
+        call_window["decreased_at"] = time.monotonic()
+        logger.info("[Extraction] Provider throttling (%s): concurrency %s → %s",
+                    status_code, previous, int(call_window["window"]))
+    if status_code in PROVIDER_ERROR_STATUS_CODES or isinstance(response, litellm.Timeout):
+        call_window["consecutive_failures"] += 1
+        if call_window["consecutive_failures"] >= EXTRACTION_BREAKER_THRESHOLD:
+            call_window["consecutive_failures"] = 0
+            call_window["open_until"] = time.monotonic() + EXTRACTION_BREAKER_SECONDS
+            logger.warning("[Extraction] ⚠️  %s provider failures in a row; pausing calls for %ss",
+                           EXTRACTION_BREAKER_THRESHOLD, EXTRACTION_BREAKER_SECONDS)
+
+# Short records (first bin) are sent several to a call, sharing one copy of the instructions; set
+# "extraction_batch_size" per pipeline or EXTRACTION_BATCH_SIZE for all (1 disables batching)
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "10"))
+EXTRACTION_MAX_BATCH_SIZE = 25
+
+def _extraction_bin(prompt_chars):
+    """Index into EXTRACTION_BINS for a prompt of this length (~4 characters per token)"""
+    est_tokens = prompt_chars // 4
+    for i, (max_tokens, _, _) in enumerate(EXTRACTION_BINS):
+        if max_tokens is None or est_tokens <= max_tokens:
+            return i
+
+def schema_type_to_json_schema(type_name):
+    """Convert a DocETL output_schema type ("string", "list[str]", ...) to a JSON schema"""
+    type_name = type_name.strip().lower()
+    if type_name in ("str", "text", "string", "varchar"):
+        return {"type": "string"}
+    if type_name in ("int", "integer"):
+        return {"type": "integer"}
+    if type_name in ("float", "decimal", "number"):
+        return {"type": "number"}
+    if type_name in ("bool", "boolean"):
+        return {"type": "boolean"}
+    if type_name.startswith("list[") and type_name.endswith("]"):
+        return {"type": "array", "items": schema_type_to_json_schema(type_name[5:-1])}
+    raise ValueError(f"Unsupported output_schema type: {type_name}")
+
+def extraction_response_format(output_schema, batch=False):
+    """
+    Strict json_schema response format for an output_schema, so the provider can only return
+    objects with exactly these keys and types. LiteLLM translates it to a forced tool call for
+    Anthropic models.
+
+    With batch=True the reply is {"results": [...]}: one such object per record of a batched
+    call, each also carrying the record's "index".
+    """
+    properties = {key: schema_type_to_json_schema(value) for key, value in output_schema.items()}
+    required = list(output_schema)
+    if batch:
+        properties = {"index": {"type": "integer"}, **properties}
+        required = ["index", *required]
+    schema = {"type": "object", "properties": properties, "required": required, "additionalProperties": False}
+    if batch:
+        schema = {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": schema}},
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "extraction_batch" if batch else "extraction", "schema": schema, "strict": True}
+    }
+
+def _extraction_system_prompt(pipeline_config, batch=False):
+    """System prompt equivalent to the one DocETL builds for a map operation"""
+    fields = ", ".join(pipeline_config["output_schema"])
+    if batch:
+        task = (
+            "Perform the specified task on each of the provided records separately and as precisely as possible. "
+            f'Respond with a JSON object {{"results": [...]}} holding one object per record, with the '
+            f"record's number as index and these keys: {fields}."
+        )
+    else:
+        task = (
+            "Perform the specified task on the provided record as precisely as possible. "
+            f"Respond with a single JSON object with these keys: {fields}."
+        )
+    return (
+        f"You are {pipeline_config['persona']}, helping the user make sense of their data. "
+        f"The dataset description is: {pipeline_config['dataset_description']}. {task}"
+    )
 
-        # Calculate actual cost using LiteLLM
+def batchable_extraction_prompt(prompt_source):
+    """
+    Whether an extraction prompt can be batched: a batched call renders the prompt once with the
+    records listed after it, so the prompt may only use the record as a whole ({{ input }})
+    """
+    return "{{ input }}" in prompt_source and "input." not in prompt_source and "input[" not in prompt_source
+
+def _batch_extraction_prompt(template, records):
+    """User prompt for a batched call: the task once, then the records numbered from 0"""
+    task = template.render(input="(each of the numbered records below)")
+    # str(record) is what {{ input }} renders for a single record
+    listed = "\n\n".join(f"Record {n}: {record}" for n, record in enumerate(records))
+    return f"{task}\n\nThe {len(records)} records:\n\n{listed}"
+
+def _passes_validation(output, validation_rules):
+    """Evaluate the same rules DocETL does, e.g. 'output["date"] != ""'"""
+    for rule in validation_rules:
         try:
-            cost = completion_cost(completion_response=response_obj)
-        except Exception as e:
-            print(f"[Cost Tracking] Warning: Could not calculate cost: {e}")
-            cost = 0.0
+            if not eval(rule, {"__builtins__": {}}, {"output": output}):
+                return False
+        except Exception:
+            return False
+    return True
 
-        # Thread-safe tracking
-        with _cost_tracker["lock"]:
-            _cost_tracker["calls"].append({
-                "model": model,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-                "cost": cost,
-                "operation": _cost_tracker.get("operation_context", "unknown")
-            })
+def _parse_extraction(response, validation_rules):
+    """
+    Return the extracted fields from one completion, or None if the call failed,
+    the reply isn't a JSON object, or it fails a validation rule
+    """
+    if isinstance(response, Exception):
+        return None
+    try:
+        content = response.choices[0].message.content
+    except (AttributeError, IndexError):
+        return None
+    return _parse_extraction_content(content, validation_rules)
 
+def _parse_extraction_content(content, validation_rules):
+    """Return the extracted fields from a reply's message content, or None if invalid"""
+    try:
+        output = orjson.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(output, dict) or not _passes_validation(output, validation_rules):
+        return None
+    return output
+
+def _matches_source_record(output, record):
+    """
+    Whether a batched result belongs to the record at its index: the extracted record_id must occur
+    in that record's text. Guards against the model swapping or shifting indexes, which would give
+    one record another's date and record_id.
+    """
+    record_id = output.get("record_id")
+    return isinstance(record_id, str) and record_id.strip() != "" and record_id.strip() in str(record)
+
+def _parse_batch_extraction(response, batch_records, validation_rules):
+    """
+    Return {record number: extracted fields} for the records a batched completion answered validly
+    and verifiably (see _matches_source_record)
+    """
+    if isinstance(response, Exception):
+        return {}
+    try:
+        results = orjson.loads(response.choices[0].message.content)["results"]
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return {}
+    if not isinstance(results, list):
+        return {}
+
+    answered = {}
+    for output in results:
+        if not isinstance(output, dict):
+            continue
+        index = output.pop("index", None)
+        if (isinstance(index, int) and 0 <= index < len(batch_records) and index not in answered
+                and _passes_validation(output, validation_rules)
+                and _matches_source_record(output, batch_records[index])):
+            answered[index] = output
+    return answered
+
+def run_async(coroutine):
+    """
+    Run a coroutine to completion from sync code.
+
+    The pipeline is called from FastAPI handlers, where an event loop is already running and
+    asyncio.run() isn't allowed; there the coroutine gets its own loop on a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="extraction-loop") as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+# Pipelines with "extraction_model_simple" send records classify_complexity() rates "low" (short,
+# routine entries such as a single lab result) to that cheaper model; everything else keeps
+# "extraction_model". Record text is rated as {{ input }} renders it (~4 characters per token).
+# Routing is off when an extraction api_base is set (see extraction_models).
+COMPLEXITY_LOW_MAX_CHARS = 1_500
+COMPLEXITY_HIGH_MIN_CHARS = 6_000
+COMPLEX_RECORD_PATTERN = re.compile(
+    r"differential diagnos|mental status exam|history of present illness|assessment and plan|"
+    r"competenc|capacity|suicid|homicid|against medical advice|informed consent|adverse event",
+    re.IGNORECASE
+)
+ICD10_CODE_PATTERN = re.compile(r"\b[A-TV-Z]\d{2}(?:\.[0-9A-Z]{1,4})?\b")
+
+def classify_complexity(record_text):
+    """
+    Rate how demanding a record is to extract: "high" for long records or clinical reasoning
+    (differential diagnosis, mental status exam, competency, ...), "medium" for mid-length
+    records or several distinct ICD-10 codes, "low" otherwise
+    """
+    if len(record_text) > COMPLEXITY_HIGH_MIN_CHARS or COMPLEX_RECORD_PATTERN.search(record_text):
+        return "high"
+    if len(record_text) > COMPLEXITY_LOW_MAX_CHARS or len(set(ICD10_CODE_PATTERN.findall(record_text))) > 1:
+        return "medium"
+    return "low"
+
+def extraction_models(input_data, pipeline_config, extraction_model):
+    """
+    Model each record is extracted with: extraction_model_simple for "low" records, if configured.
+    No routing when extraction goes to a self-hosted server (extraction_api_base): the api_base
+    applies to every call, and the server only serves the pipeline's extraction model.
+    """
+    simple_model = pipeline_config.get("extraction_model_simple")
+    if not simple_model or extraction_completion_kwargs(pipeline_config):
+        return [extraction_model] * len(input_data)
+    # str(record) is what {{ input }} renders for a record
+    return [
+        simple_model if classify_complexity(str(record)) == "low" else extraction_model
+        for record in input_data
+    ]
+
+def extraction_messages(input_data, pipeline_config):
+    """Chat messages for each record's extraction call (system prompt + rendered extraction prompt)"""
+    template = compile_template(pipeline_config["extraction_prompt"])
+    system_message = {"role": "system", "content": _extraction_system_prompt(pipeline_config)}
+    return [
+        [system_message, {"role": "user", "content": template.render(input=record)}]
+        for record in input_data
+    ]
+
+def extract_records_direct(input_data, pipeline_config, extraction_model, run_id=None):
+    """
+    Run the extraction step with concurrent LiteLLM calls instead of a DocETL pipeline.
+
+    Matches the DocETL map operation it replaces: the pipeline's extraction prompt is rendered
+    per record, replies are constrained to output_schema, validation rules (e.g. non-empty date)
+    are enforced with retries, extracted fields are merged over the input record (pass_through),
+    and records that still fail are skipped (skip_on_error).
+
+    Every call is limited by its size bin's semaphore and by an adaptive (AIMD) window of at most
+    EXTRACTION_MAX_IN_FLIGHT calls overall, which shrinks when the provider throttles.
+    Short records are sent extraction_batch_size to a call; records a batched call doesn't answer
+    validly, or whose result can't be matched to the record, get their own call. A failed record
+    is retried as soon as it fails, without waiting for the rest. With "extraction_model_simple"
+    set, low-complexity records go to that model. With ENABLE_LLM_CACHE=1, records whose exact
+    call was answered before are served from the LLM response cache instead, and single-record
+    results are checkpointed to it as they complete, so a re-run after an interruption only
+    extracts the records that were left (batched results aren't cached: the cache key is the
+    single-record call).
+
+    Args:
+        input_data: List of document records
+        pipeline_config: Pipeline configuration dict
+        extraction_model: Model to use for extraction
+        run_id: Cost tracker run the calls are recorded for (see start_cost_run)
+
+    Returns:
+        (list of extracted records in input order, number of records served from the LLM response cache)
+    """
+    outputs, cache_hits = extract_outputs_direct(input_data, pipeline_config, extraction_model, run_id)
+    extracted_records = [
+        {**record, **output}
+        for record, output in zip(input_data, outputs)
+        if output is not None
+    ]
+    return extracted_records, cache_hits
+
+def extract_outputs_direct(input_data, pipeline_config, extraction_model, run_id=None):
+    """
+    Extracted fields per input record (None where extraction failed) and the number of records
+    served from the LLM response cache; see extract_records_direct
+    """
+    template = compile_template(pipeline_config["extraction_prompt"])
+    messages = extraction_messages(input_data, pipeline_config)
+    record_models = extraction_models(input_data, pipeline_config, extraction_model)
+    response_format = extraction_response_format(pipeline_config["output_schema"])
+    validation_rules = pipeline_config.get("extraction_validation", [])
+    max_retries = pipeline_config.get("num_retries_on_validate_failure", 2)
+    completion_kwargs = extraction_completion_kwargs(pipeline_config)
+    retries = 0
+    unbatched = 0
+
+    outputs = [None] * len(messages)
+    if LLM_CACHE_ENABLED:
+        cache_keys = [
+            llm_cache_key(model, m, response_format, validation_rules, completion_kwargs)
+            for model, m in zip(record_models, messages)
+        ]
+        cached = load_cached_responses(cache_keys)
+        outputs = [cached.get(key) for key in cache_keys]
+    pending = [i for i, output in enumerate(outputs) if output is None]
+    cache_hits = len(messages) - len(pending)
+    routed = sum(model != extraction_model for model in record_models)
+    if routed:
+        logger.info("[Extraction] Routing %s of %s low-complexity record(s) to %s",
+                    routed, len(messages), pipeline_config["extraction_model_simple"])
+    if cache_hits:
+        logger.info("[Extraction] ✓ %s of %s record(s) served from the LLM response cache", cache_hits, len(messages))
+
+    # Group short records into batched calls, one model per call
+    batch_size = min(pipeline_config.get("extraction_batch_size", EXTRACTION_BATCH_SIZE), EXTRACTION_MAX_BATCH_SIZE)
+    batches = []
+    # Batched results are matched back to records by record_id, so the schema must have one
+    if (batch_size > 1 and "record_id" in pipeline_config["output_schema"]
+            and batchable_extraction_prompt(pipeline_config["extraction_prompt"])):
+        for model in dict.fromkeys(record_models):
+            short = [
+                i for i in pending
+                if record_models[i] == model and _extraction_bin(len(messages[i][1]["content"])) == 0
+            ]
+            if len(short) > 1:
+                batches += [short[start:start + batch_size] for start in range(0, len(short), batch_size)]
+    batched = {i for batch in batches for i in batch}
+    singles = [i for i in pending if i not in batched]
+    batch_system_message = {"role": "system", "content": _extraction_system_prompt(pipeline_config, batch=True)}
+    batch_response_format = extraction_response_format(pipeline_config["output_schema"], batch=True)
+
+    async def complete(model, call_messages, call_response_format, limits):
+        """One acompletion call; returns the exception instead of raising"""
+        call_window, bin_semaphores = limits
+        bin_index = _extraction_bin(len(call_messages[1]["content"]))
+        async with bin_semaphores[bin_index]:
+            if time.monotonic() < call_window["open_until"]:
+                return RuntimeError("Extraction circuit breaker open")
+            await _acquire_call_slot(call_window)
+            started = time.monotonic()
+            try:
+                response = await litellm.acompletion(
+                    model=model,
+                    messages=call_messages,
+                    response_format=call_response_format,
+                    timeout=EXTRACTION_BINS[bin_index][2],
+                    metadata=llm_call_metadata(run_id, "extraction"),
+                    **completion_kwargs
+                )
+                record_llm_call(run_id, "extraction", model, response)
+            except Exception as e:
+                response = e
+            _record_call_outcome(call_window, response, started)
+            await _release_call_slot(call_window)
+        # Back off outside the limits, so the throttled call doesn't hold a slot while it waits
+        if isinstance(response, Exception) and getattr(response, "status_code", None) in THROTTLE_STATUS_CODES:
+            retry_after = _retry_after_seconds(response)
+            if retry_after:
+                await asyncio.sleep(retry_after)
+        return response
+
+    checkpoint = []
+
+    def record_output(i, output, cache=True):
+        outputs[i] = output
+        if cache and LLM_CACHE_ENABLED:
+            checkpoint.append((cache_keys[i], output))
+            if len(checkpoint) >= LLM_CACHE_CHECKPOINT_SIZE:
+                save_cached_responses(checkpoint)
+                checkpoint.clear()
+
+    async def extract(i, limits):
+        nonlocal retries
+        call_window = limits[0]
+        for attempt in range(max_retries + 1):
+            if attempt:
+                retries += 1
+                # While the breaker is open, wait for it to close instead of failing again
+                await asyncio.sleep(max(0.0, call_window["open_until"] - time.monotonic()))
+            response = await complete(record_models[i], messages[i], response_format, limits)
+            output = _parse_extraction(response, validation_rules)
+            if output is not None:
+                record_output(i, output)
+                return
+
+    async def extract_batch(batch, limits):
+        nonlocal unbatched
+        batch_messages = [
+            batch_system_message,
+            {"role": "user", "content": _batch_extraction_prompt(template, [input_data[i] for i in batch])}
+        ]
+        response = await complete(record_models[batch[0]], batch_messages, batch_response_format, limits)
+        answered = _parse_batch_extraction(response, [input_data[i] for i in batch], validation_rules)
+        for n, output in answered.items():
+            # Not cached: the key is the single-record call, whose answer this isn't
+            record_output(batch[n], output, cache=False)
+        leftovers = [i for n, i in enumerate(batch) if n not in answered]
+        unbatched += len(leftovers)
+        await asyncio.gather(*(extract(i, limits) for i in leftovers))
+
+    async def extract_all():
+        # Semaphores and the window's condition are created here so they belong to the loop that runs the calls
+        limits = (
+            new_call_window(EXTRACTION_MAX_IN_FLIGHT),
+            [asyncio.Semaphore(concurrency) for _, concurrency, _ in EXTRACTION_BINS]
+        )
+        await asyncio.gather(
+            *(extract_batch(batch, limits) for batch in batches),
+            *(extract(i, limits) for i in singles)
+        )
+
+    if pending:
+        if batches:
+            logger.info("[Extraction] Sending %s short record(s) in %s batched call(s)", len(batched), len(batches))
+        try:
+            run_async(extract_all())
+        finally:
+            # Also on failure: whatever completed is kept for the next run
+            if checkpoint:
+                save_cached_responses(checkpoint)
+
+    if unbatched:
+        logger.warning("[Extraction] %s batched record(s) not answered validly or not matched to their record; "
+                       "sent on their own", unbatched)
+    if retries:
+        logger.warning("[Extraction] Retried failed records %s time(s) (up to %s per record)", retries, max_retries)
+
+    skipped = sum(output is None for output in outputs)
+    if skipped:
+        logger.warning("[Extraction] ⚠️  Skipping %s record(s) that failed extraction", skipped)
+
+    return outputs, cache_hits
+
+# Non-interactive runs (batch_mode=True) can send extraction through the provider's Batch API instead:
+# about half the price, but results may take up to the 24h completion window. LiteLLM's batch API covers
+# OpenAI-compatible providers; other extraction models fall back to real-time calls.
+BATCH_API_PROVIDERS = ("openai", "azure")
+EXTRACTION_BATCH_POLL_SECONDS = int(os.getenv("EXTRACTION_BATCH_POLL_SECONDS", "30"))
+# The polling run holds a server threadpool worker, so give up (and cancel the job) well before
+# the provider's 24h window
+EXTRACTION_BATCH_MAX_WAIT_SECONDS = int(os.getenv("EXTRACTION_BATCH_MAX_WAIT_SECONDS", "7200"))
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def _record_batch_call(body, model, provider, run_id):
+    """Cost of one Batch API reply at batch rates, recorded like a real-time call's"""
+    usage = body.get("usage") or {}
+    try:
+        prompt_cost, completion_cost_ = batch_cost_calculator(
+            usage=litellm.Usage(**usage), model=model, custom_llm_provider=provider
+        )
+        cost = prompt_cost + completion_cost_
     except Exception as e:
-        print(f"[Cost Tracking] Error in callback: {e}")
+        _warn_unpriced_model(model, str(e))
+        cost = 0.0
+    record_llm_usage(run_id, "extraction", model, usage, cost)
 
-# Install the callback globally for all LiteLLM calls
-litellm.success_callback = [track_llm_costs]
-# ============= END Cost Tracking =============
+def extract_records_batch_api(input_data, pipeline_config, extraction_model, run_id=None):
+    """
+    Run the extraction step as one provider Batch API job, for runs that aren't latency-critical.
+
+    Every record's extraction call (same messages and strict response format as the direct
+    backend) is written to a JSONL file keyed by its input position, uploaded, and submitted as a
+    batch; the job is polled every EXTRACTION_BATCH_POLL_SECONDS until it finishes. Records the
+    job doesn't answer validly (errors, failed validation, an expired job) are then extracted
+    with real-time calls and their usual retries. With ENABLE_LLM_CACHE=1 cached records are
+    left out of the job and batch results are saved to the cache.
+
+    A batch job runs on a single model, so "extraction_model_simple" routing does not apply:
+    every record in the job goes to extraction_model. Only the real-time retries are routed.
+
+    Args:
+        input_data: List of document records
+        pipeline_config: Pipeline configuration dict
+        extraction_model: Model to use for extraction
+
+    Returns:
+        (list of extracted records in input order, number of records served from the LLM response cache)
+
+    Raises:
+        TimeoutError: If the job hasn't finished after EXTRACTION_BATCH_MAX_WAIT_SECONDS (it is cancelled)
+    """
+    model, provider, _, _ = litellm.get_llm_provider(extraction_model)
+    if provider not in BATCH_API_PROVIDERS:
+        logger.warning("[Extraction] Batch API not available for %s; using real-time calls", extraction_model)
+        return extract_records_direct(input_data, pipeline_config, extraction_model, run_id)
+
+    messages = extraction_messages(input_data, pipeline_config)
+    response_format = extraction_response_format(pipeline_config["output_schema"])
+    validation_rules = pipeline_config.get("extraction_validation", [])
+    completion_kwargs = extraction_completion_kwargs(pipeline_config)
+
+    outputs = [None] * len(messages)
+    if LLM_CACHE_ENABLED:
+        cache_keys = [
+            llm_cache_key(extraction_model, m, response_format, validation_rules, completion_kwargs)
+            for m in messages
+        ]
+        cached = load_cached_responses(cache_keys)
+        outputs = [cached.get(key) for key in cache_keys]
+    pending = [i for i, output in enumerate(outputs) if output is None]
+    cache_hits = len(messages) - len(pending)
+
+    if pending:
+        requests = b"\n".join(
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": messages[i], "response_format": response_format}
+            })
+            for i in pending
+        )
+        batch_file = litellm.create_file(
+            file=("extraction_batch.jsonl", requests), purpose="batch", custom_llm_provider=provider, **completion_kwargs
+        )
+        batch = litellm.create_batch(
+            completion_window="24h",
+            endpoint="/v1/chat/completions",
+            input_file_id=batch_file.id,
+            custom_llm_provider=provider,
+            **completion_kwargs
+        )
+        logger.info("[Extraction] Submitted %s record(s) as batch %s", len(pending), batch.id)
+
+        deadline = time.monotonic() + EXTRACTION_BATCH_MAX_WAIT_SECONDS
+        while batch.status not in BATCH_TERMINAL_STATUSES:
+            if time.monotonic() >= deadline:
+                try:
+                    litellm.cancel_batch(batch_id=batch.id, custom_llm_provider=provider, **completion_kwargs)
+                except Exception as e:
+                    logger.warning("[Extraction] Could not cancel batch %s: %s", batch.id, e)
+                raise TimeoutError(
+                    f"Extraction batch {batch.id} still {batch.status} after {EXTRACTION_BATCH_MAX_WAIT_SECONDS}s; "
+                    "cancelled it (raise EXTRACTION_BATCH_MAX_WAIT_SECONDS to wait longer)"
+                )
+            time.sleep(EXTRACTION_BATCH_POLL_SECONDS)
+            batch = litellm.retrieve_batch(batch_id=batch.id, custom_llm_provider=provider, **completion_kwargs)
+            counts = batch.request_counts
+            if counts is not None:
+                logger.info("[Extraction] Batch %s: %s (%s/%s done)", batch.id, batch.status, counts.completed, counts.total)
+        logger.info("[Extraction] Batch %s finished: %s", batch.id, batch.status)
+
+        # Expired and cancelled jobs still return the requests that completed
+        answered = []
+        if batch.output_file_id:
+            content = litellm.file_content(
+                file_id=batch.output_file_id, custom_llm_provider=provider, **completion_kwargs
+            ).content
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                result = orjson.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                body = response.get("body") or {}
+                _record_batch_call(body, model, provider, run_id)
+                try:
+                    reply = body["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    continue
+                output = _parse_extraction_content(reply, validation_rules)
+                if output is not None:
+                    i = int(result["custom_id"])
+                    outputs[i] = output
+                    answered.append(i)
+        if LLM_CACHE_ENABLED and answered:
+            save_cached_responses([(cache_keys[i], outputs[i]) for i in answered])
+
+        leftovers = [i for i in pending if outputs[i] is None]
+        if leftovers:
+            logger.warning("[Extraction] %s record(s) not answered validly by the batch; extracting them directly",
+                           len(leftovers))
+            retried, _ = extract_outputs_direct([input_data[i] for i in leftovers], pipeline_config, extraction_model, run_id)
+            for i, output in zip(leftovers, retried):
+                outputs[i] = output
+
+    extracted_records = [
+        {**record, **output}
+        for record, output in zip(input_data, outputs)
+        if output is not None
+    ]
+    return extracted_records, cache_hits
+# ============= END Direct Extraction =============
+
+def extract_json_object(text):
+    """
+    Return the first balanced {...} object in text, e.g. from inside a ```json fence.
+
+    Single pass that tracks brace depth, skipping braces inside strings (and escaped quotes).
+    Returns the text from the first "{" on if the object is never closed, or text unchanged
+    if there is no "{", so orjson.loads reports the error.
+    """
+    start = text.find("{")
+    if start < 0:
+        return text
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+
+    return text[start:]
+
+# In a custom analysis_prompt, everything before this loop is static and can be prompt-cached
+RECORDS_LOOP_MARKER = "{% for record in inputs %}"
+
+@lru_cache(maxsize=None)
+def split_analysis_prompt(prompt_source):
+    """
+    Split a custom analysis_prompt at its records loop
+
+    Returns:
+        (static text before the loop, compiled template for the records part).
+        The static text is "" when the prompt has no records loop.
+    """
+    static_prompt, loop, records_source = prompt_source.partition(RECORDS_LOOP_MARKER)
+    if not loop:
+        return "", compile_template(prompt_source)
+    return static_prompt, compile_template(loop + records_source)
+
+def build_analysis_messages(model, system_prompt, static_prompt, dynamic_prompt):
+    """
+    Build chat messages with the static part of the prompt ahead of the per-run part.
 
-def analyze_records_for_red_flags(sorted_records, analysis_model, pipeline_config):
+    For Anthropic models the static prefix (system prompt plus static_prompt) is marked with
+    cache_control so repeat analyses are billed at the cached-input rate. OpenAI caches
+    identical prefixes automatically, so plain string content is enough there.
+    """
+    if not (model.startswith("claude") or model.startswith("anthropic/")):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": static_prompt + dynamic_prompt}
+        ]
+
+    if not static_prompt:
+        # No static instructions: cache the system prompt alone
+        return [
+            {"role": "system", "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]},
+            {"role": "user", "content": dynamic_prompt}
+        ]
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": [
+            {"type": "text", "text": static_prompt, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": dynamic_prompt}
+        ]}
+    ]
+
+def cited_record_ids(item):
+    """Record IDs an analysis item cites: its "records" list, or a comma-separated string"""
+    cited_records = item.get("records")
+    if isinstance(cited_records, str):
+        return [r.strip() for r in cited_records.split(",")]
+    return cited_records if isinstance(cited_records, list) else []
+
+def find_hallucinated_record_ids(items, valid_ids):
+    """Record IDs cited in analysis items that don't exist in the input data"""
+    return [
+        record_id
+        for item in items if isinstance(item, dict)
+        for record_id in cited_record_ids(item)
+        if record_id and record_id not in valid_ids
+    ]
+
+def format_analysis_field(analysis_schema, field_name, raw_data, string_formatter):
+    """
+    Format an analysis field based on the pipeline's schema specification.
+    If schema specifies list[dict], return objects.
+    If schema specifies list[str], convert to strings.
+    Default to strings for backward compatibility.
+    """
+    schema_type = analysis_schema.get(field_name, "list[str]")
+
+    if schema_type == "list[dict]":
+        # Return structured objects
+        logger.info("[Analysis] Returning %s as structured objects (schema: list[dict])", field_name)
+        return raw_data
+
+    # Convert to pipe-delimited strings (backward compatibility)
+    logger.info("[Analysis] Converting %s to strings (schema: %s)", field_name, schema_type)
+    return [string_formatter(item) if isinstance(item, dict) else str(item) for item in raw_data]
+
+def _records_str(item):
+    records = item.get("records")
+    return ", ".join(records) if isinstance(records, list) else (records or "Unknown")
+
+def format_red_flag(flag):
+    return (
+        f"Category: {flag.get('category', 'unknown')} | "
+        f"Issue: {flag.get('issue', 'No description')} | "
+        f"Records: {_records_str(flag)} | "
+        f"Legal Relevance: {flag.get('legal_relevance', 'unknown')}"
+    )
+
+def format_contradiction(contradiction):
+    return (
+        f"Records {contradiction.get('records', 'Unknown')}: "
+        f"{contradiction.get('description', 'No description')} | "
+        f"Legal Relevance: {contradiction.get('legal_relevance', 'unknown')}"
+    )
+
+def format_expert_opinion(opinion):
+    return (
+        f"Topic: {opinion.get('topic', 'Unknown')} | "
+        f"Records: {_records_str(opinion)} | "
+        f"Reason: {opinion.get('reason', 'No description')}"
+    )
+
+# Analysis output fields and the formatter for their pipe-delimited string form (list[str] schemas)
+ANALYSIS_FIELD_FORMATTERS = (
+    ("red_flags", format_red_flag),
+    ("contradictions", format_contradiction),
+    ("expert_opinions_needed", format_expert_opinion),
+)
+
+def analyze_records_for_red_flags(sorted_records, analysis_model, pipeline_config, run_id=None):
     """
     Optional LLM analysis step for deep insights after Python assembly.
 
@@ -70,59 +1081,60 @@ def analyze_records_for_red_flags(sorted_records, analysis_model, pipeline_confi
         sorted_records: List of extracted records (sorted chronologically)
         analysis_model: Model to use (e.g., "claude-sonnet-4-5-20250929")
         pipeline_config: Pipeline configuration dict
+        run_id: Cost tracker run the call is recorded for (see start_cost_run)
 
     Returns:
-        Dict with red_flags, contradictions, expert_opinions_needed
+        Dict with red_flags, contradictions, expert_opinions_needed, or None if the LLM call or
+        its response parsing failed
     """
-    try:
-        print(f"[Analysis] Starting deep analysis with {analysis_model}...")
+    use_cache = PIPELINE_CACHE_ENABLED and ANALYSIS_TEMPERATURE <= ANALYSIS_CACHE_MAX_TEMPERATURE
+    if use_cache:
+        cache_key = analysis_cache_key(sorted_records, analysis_model, pipeline_config)
+        cached_result = load_cached_analysis(cache_key, max_age_seconds=ANALYSIS_CACHE_TTL)
+        if cached_result is not None:
+            logger.info("[Analysis] ✓ Cache hit (%s): reusing analysis, no LLM call made", cache_key)
+            return cached_result
 
-        # Set operation context for cost tracking
-        with _cost_tracker["lock"]:
-            _cost_tracker["operation_context"] = "analysis"
+    try:
+        logger.info("[Analysis] Starting deep analysis with %s...", analysis_model)
 
         # Extract valid record IDs for grounding
         valid_record_ids = [record.get('record_id', '') for record in sorted_records if record.get('record_id')]
         valid_ids_str = ", ".join(valid_record_ids)
-        print(f"[Analysis] Grounding LLM with {len(valid_record_ids)} valid record IDs")
+        logger.info("[Analysis] Grounding LLM with %s valid record IDs", len(valid_record_ids))
 
         # Construct analysis prompt
         persona = pipeline_config.get("persona", "a forensic medical expert")
         dataset_description = pipeline_config.get("dataset_description", "medical records")
 
-        # Use custom analysis_prompt from pipeline config if available, otherwise use default
+        # The prompt is split into a static prefix (task and output format, identical on every run)
+        # and the per-run records, so providers can cache the prefix
         if "analysis_prompt" in pipeline_config:
-            # Pipeline provides custom analysis prompt with Jinja template
-            print(f"[Analysis] Using custom analysis prompt from pipeline config")
-            template = Template(pipeline_config["analysis_prompt"])
+            # Pipeline provides custom analysis prompt with Jinja template: everything before the
+            # records loop is static
+            logger.info("[Analysis] Using custom analysis prompt from pipeline config")
+            static_prompt, records_template = split_analysis_prompt(pipeline_config["analysis_prompt"])
 
             # Render template with structured records (not text summaries!)
-            analysis_prompt = template.render(inputs=sorted_records)
+            records_prompt = records_template.render(inputs=sorted_records)
         else:
             # Use default hardcoded prompt for backward compatibility
-            print(f"[Analysis] Using default analysis prompt")
+            logger.info("[Analysis] Using default analysis prompt")
             # Build text summary for default prompt
-            records_summary = []
-            for i, record in enumerate(sorted_records, 1):
-                summary = (
-                    f"{i}. Date: {record.get('date', 'Unknown')} | "
-                    f"ID: {record.get('record_id', 'Unknown')} | "
-                    f"Provider: {record.get('provider', 'Unknown')} | "
-                    f"Event: {record.get('event_type', 'unknown')} | "
-                    f"Description: {record.get('event_description', 'No description')} | "
-                    f"Diagnosis: {record.get('diagnosis', 'None')} | "
-                    f"Confidence: {record.get('confidence', 'unknown')}"
-                )
-                records_summary.append(summary)
-
-            analysis_prompt = f"""You are {persona} analyzing {dataset_description}.
-
-Below are {len(sorted_records)} extracted medical records in chronological order. Each record has been extracted and validated.
+            records_summary = "\n".join(
+                f"{i}. Date: {record.get('date', 'Unknown')} | "
+                f"ID: {record.get('record_id', 'Unknown')} | "
+                f"Provider: {record.get('provider', 'Unknown')} | "
+                f"Event: {record.get('event_type', 'unknown')} | "
+                f"Description: {record.get('event_description', 'No description')} | "
+                f"Diagnosis: {record.get('diagnosis', 'None')} | "
+                f"Confidence: {record.get('confidence', 'unknown')}"
+                for i, record in enumerate(sorted_records, 1)
+            )
 
-RECORDS:
-{chr(10).join(records_summary)}
+            static_prompt = f"""You are {persona} analyzing {dataset_description}.
 
-TASK: Analyze these records for critical issues that would be relevant in a legal/forensic context.
+TASK: Analyze the records below for critical issues that would be relevant in a legal/forensic context.
 
 Return JSON with three fields:
 
@@ -136,7 +1148,14 @@ Return JSON with three fields:
 3. "expert_opinions_needed": Areas requiring expert medical interpretation
    - Format: "Topic: [topic] | Records: [record IDs] | Reason: [why expert needed]"
 
-Be thorough but concise. Only include significant issues. Always cite specific record IDs."""
+Be thorough but concise. Only include significant issues. Always cite specific record IDs.
+
+"""
+
+            records_prompt = f"""Below are {len(sorted_records)} extracted medical records in chronological order. Each record has been extracted and validated.
+
+RECORDS:
+{records_summary}"""
 
         # Add grounding constraints to prevent hallucinations
         grounding_instructions = f"""
@@ -148,192 +1167,191 @@ Valid record IDs in this dataset: {valid_ids_str}
 Do NOT invent, assume, or reference any record IDs that are not in this list.
 If you cannot find evidence of an issue in the actual records provided, do not report it."""
 
-        analysis_prompt += grounding_instructions
+        records_prompt += grounding_instructions
 
         # Call LLM
         response = litellm.completion(
             model=analysis_model,
-            messages=[
-                {"role": "system", "content": f"You are {persona}."},
-                {"role": "user", "content": analysis_prompt}
-            ],
-            temperature=0.1  # Low temperature for consistency
+            messages=build_analysis_messages(analysis_model, f"You are {persona}.", static_prompt, records_prompt),
+            temperature=ANALYSIS_TEMPERATURE,
+            response_format={"type": "json_object"},
+            metadata=llm_call_metadata(run_id, "analysis")
         )
+        record_llm_call(run_id, "analysis", analysis_model, response)
 
         # Parse response
         response_content = response.choices[0].message.content
 
-        # Try to extract JSON from response (Claude sometimes wraps JSON in markdown)
-        if "```json" in response_content:
-            # Extract JSON from markdown code block
-            json_start = response_content.find("```json") + 7
-            json_end = response_content.find("```", json_start)
-            response_content = response_content[json_start:json_end].strip()
-        elif "```" in response_content:
-            # Generic code block
-            json_start = response_content.find("```") + 3
-            json_end = response_content.find("```", json_start)
-            response_content = response_content[json_start:json_end].strip()
-
-        result = json.loads(response_content)
+        # JSON mode returns bare JSON; fall back to scanning for the object if the model
+        # wrapped it in markdown or prose anyway
+        try:
+            result = orjson.loads(response_content)
+        except ValueError:
+            result = orjson.loads(extract_json_object(response_content))
 
         # Get raw LLM results
-        raw_red_flags = result.get("red_flags", [])
-        raw_contradictions = result.get("contradictions", [])
-        raw_expert_opinions = result.get("expert_opinions_needed", [])
-
-        print(f"[Analysis] ✓ Found {len(raw_red_flags)} red flag(s), {len(raw_contradictions)} contradiction(s), {len(raw_expert_opinions)} expert opinion(s) needed")
-
-        # VALIDATION: Check for hallucinated record IDs
-        def validate_record_ids(items, field_name):
-            """Validate that cited record IDs exist in the input data"""
-            valid_ids_set = set(valid_record_ids)
-            hallucinations_found = 0
-
-            for item in items:
-                if isinstance(item, dict):
-                    cited_records = item.get("records", [])
-                    if isinstance(cited_records, str):
-                        cited_records = [r.strip() for r in cited_records.split(",")]
-                    elif not isinstance(cited_records, list):
-                        cited_records = []
-
-                    for record_id in cited_records:
-                        if record_id and record_id not in valid_ids_set:
-                            hallucinations_found += 1
-                            print(f"[Analysis] ⚠️  HALLUCINATION DETECTED in {field_name}: '{record_id}' does not exist in input data!")
-
-            if hallucinations_found > 0:
-                print(f"[Analysis] ⚠️  Total hallucinations in {field_name}: {hallucinations_found}")
-            else:
-                print(f"[Analysis] ✓ No hallucinations detected in {field_name}")
+        raw_fields = {field_name: result.get(field_name, []) for field_name, _ in ANALYSIS_FIELD_FORMATTERS}
 
-        # Validate all citation fields
-        validate_record_ids(raw_red_flags, "red_flags")
-        validate_record_ids(raw_contradictions, "contradictions")
-        validate_record_ids(raw_expert_opinions, "expert_opinions_needed")
+        logger.info("[Analysis] ✓ Found %s red flag(s), %s contradiction(s), %s expert opinion(s) needed",
+                    len(raw_fields["red_flags"]), len(raw_fields["contradictions"]), len(raw_fields["expert_opinions_needed"]))
 
-        # Get analysis schema to determine output format
+        # VALIDATION: Check for hallucinated record IDs, one summary line per affected field
+        valid_ids_set = frozenset(valid_record_ids)
+        hallucinations = {
+            field_name: find_hallucinated_record_ids(items, valid_ids_set)
+            for field_name, items in raw_fields.items()
+        }
+        hallucinations = {field_name: ids for field_name, ids in hallucinations.items() if ids}
+        for field_name, ids in hallucinations.items():
+            logger.warning("[Analysis] ⚠️  HALLUCINATION DETECTED in %s: %s cited record ID(s) not in input data: %s%s",
+                           field_name, len(ids), ", ".join(map(str, ids[:5])), ", ..." if len(ids) > 5 else "")
+        if not hallucinations:
+            logger.info("[Analysis] ✓ No hallucinated record IDs")
+
+        # Format each field as structured objects or pipe-delimited strings, per the analysis schema
         analysis_schema = pipeline_config.get("analysis_schema", {})
+        result = {
+            field_name: format_analysis_field(analysis_schema, field_name, raw_fields[field_name], formatter)
+            for field_name, formatter in ANALYSIS_FIELD_FORMATTERS
+        }
+        if use_cache:
+            save_cached_analysis(cache_key, result)
+        return result
 
-        # Helper function to format field based on schema
-        def format_field(field_name, raw_data, string_formatter):
-            """
-            Format field based on schema specification.
-            If schema specifies list[dict], return objects.
-            If schema specifies list[str], convert to strings.
-            Default to strings for backward compatibility.
-            """
-            schema_type = analysis_schema.get(field_name, "list[str]")
-
-            if schema_type == "list[dict]":
-                # Return structured objects
-                print(f"[Analysis] Returning {field_name} as structured objects (schema: list[dict])")
-                return raw_data
-            else:
-                # Convert to pipe-delimited strings (backward compatibility)
-                print(f"[Analysis] Converting {field_name} to strings (schema: {schema_type})")
-                formatted = []
-                for item in raw_data:
-                    if isinstance(item, dict):
-                        formatted.append(string_formatter(item))
-                    else:
-                        formatted.append(str(item))
-                return formatted
-
-        # Format red_flags
-        def format_red_flag(flag):
-            records_str = ", ".join(flag.get("records", [])) if isinstance(flag.get("records"), list) else flag.get("records", "Unknown")
-            return (
-                f"Category: {flag.get('category', 'unknown')} | "
-                f"Issue: {flag.get('issue', 'No description')} | "
-                f"Records: {records_str} | "
-                f"Legal Relevance: {flag.get('legal_relevance', 'unknown')}"
-            )
-
-        red_flags = format_field("red_flags", raw_red_flags, format_red_flag)
+    except Exception as e:
+        logger.exception("[Analysis] Error during LLM analysis: %s", e)
+        return None
 
-        # Format contradictions
-        def format_contradiction(contradiction):
-            return (
-                f"Records {contradiction.get('records', 'Unknown')}: "
-                f"{contradiction.get('description', 'No description')} | "
-                f"Legal Relevance: {contradiction.get('legal_relevance', 'unknown')}"
-            )
+# The only date format records may use: YYYY-MM-DD, with month and day optionally unpadded
+RECORD_DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}")
 
-        contradictions = format_field("contradictions", raw_contradictions, format_contradiction)
+def parse_record_dates(date_values):
+    """
+    Parse record dates (YYYY-MM-DD) into a datetime64[D] array, with NaT for missing or invalid dates
 
-        # Format expert_opinions_needed
-        def format_expert_opinion(opinion):
-            records_str = ", ".join(opinion.get("records", [])) if isinstance(opinion.get("records"), list) else opinion.get("records", "Unknown")
-            return (
-                f"Topic: {opinion.get('topic', 'Unknown')} | "
-                f"Records: {records_str} | "
-                f"Reason: {opinion.get('reason', 'No description')}"
-            )
+    Args:
+        date_values: List of raw 'date' values from extracted records
 
-        expert_opinions = format_field("expert_opinions_needed", raw_expert_opinions, format_expert_opinion)
+    Returns:
+        numpy datetime64[D] array, same length and order as date_values
+    """
+    # numpy's parser is more lenient than the format ("2024-01-05T10:00", "+2024-01-05", padded
+    # strings, "today", "2024-01"); anything else becomes "", which it parses as NaT
+    date_strs = [
+        value if isinstance(value, str) and RECORD_DATE_PATTERN.fullmatch(value) else ""
+        for value in date_values
+    ]
+    try:
+        # Fast path: one C-level parse of the whole column
+        return np.array(date_strs, dtype="datetime64[D]")
+    except ValueError:
+        # Unpadded dates like 2024-1-5, or out-of-range ones like 2024-13-01
+        return np.array([_parse_date_or_nat(date_str) for date_str in date_strs], dtype="datetime64[D]")
+
+def _parse_date_or_nat(date_str):
+    if not date_str:
+        return np.datetime64("NaT")
+    try:
+        return np.datetime64(datetime.strptime(date_str, '%Y-%m-%d').date())
+    except ValueError:
+        return np.datetime64("NaT")
 
-        return {
-            "red_flags": red_flags,
-            "contradictions": contradictions,
-            "expert_opinions_needed": expert_opinions
-        }
+# Fields chronology assembly and de-duplication read from every extracted record
+CHRONOLOGY_FIELDS = ("date", "record_id", "event_type", "event_description", "provider", "confidence")
+# Fields the default analysis prompt (pipelines without an analysis_prompt) reads
+DEFAULT_ANALYSIS_FIELDS = ("date", "record_id", "provider", "event_type", "event_description", "diagnosis", "confidence")
 
-    except Exception as e:
-        print(f"[Analysis] Error during LLM analysis: {e}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "red_flags": [],
-            "contradictions": [],
-            "expert_opinions_needed": []
-        }
+def analysis_prompt_fields(prompt_source):
+    """
+    Record fields an analysis_prompt template reads ({{ record.date }} in a loop over inputs),
+    or None if it uses whole records (e.g. {{ record }} or {{ inputs }})
+    """
+    ast = Environment().parse(prompt_source)
+    loop_vars = set()
+    loop_iters = set()
+    for loop in ast.find_all(nodes.For):
+        if isinstance(loop.iter, nodes.Name) and loop.iter.name == "inputs" and isinstance(loop.target, nodes.Name):
+            loop_vars.add(loop.target.name)
+            loop_iters.add(id(loop.iter))
+
+    fields = set()
+    field_reads = set()
+    for attribute in ast.find_all(nodes.Getattr):
+        if isinstance(attribute.node, nodes.Name) and attribute.node.name in loop_vars:
+            fields.add(attribute.attr)
+            field_reads.add(id(attribute.node))
+
+    for name in ast.find_all(nodes.Name):
+        if (name.ctx == "load" and (name.name in loop_vars or name.name == "inputs")
+                and id(name) not in field_reads and id(name) not in loop_iters):
+            return None
+    return fields
+
+@lru_cache(maxsize=None)
+def extracted_record_fields(pipeline):
+    """
+    Fields of an extracted record that assembly and analysis read, or None to keep whole records.
 
-def run_forensic_pipeline(input_data, pipeline="psych_timeline", hybrid_mode=False):
+    Extraction merges its output over the input record (DocETL's map always does), so extracted
+    records also carry the raw document fields, which nothing after extraction needs.
     """
-    Universal Forensic Discovery Pipeline
-    Uses DocETL to analyze documents
+    pipeline_config = get_pipeline_config(pipeline)
+    fields = set(pipeline_config["output_schema"]) | set(CHRONOLOGY_FIELDS)
+    if "analysis_prompt" in pipeline_config:
+        prompt_fields = analysis_prompt_fields(pipeline_config["analysis_prompt"])
+        if prompt_fields is None:
+            return None
+        fields |= prompt_fields
+    else:
+        fields.update(DEFAULT_ANALYSIS_FIELDS)
+    return tuple(sorted(fields))
+
+def unique_input_records(input_data):
+    """
+    Drop input records whose content exactly matches an earlier record (key order ignored)
 
     Args:
-        input_data: List of document records (JSON objects)
-        pipeline: One of "psych_timeline", "psych_expert_witness", "medical_chronology"
-        hybrid_mode: If True, uses Claude Sonnet 4 for analysis (higher quality, higher cost)
+        input_data: List of document records
 
     Returns:
-        Dict with "analysis" and "cost_data" keys
+        List of distinct records, in first-seen order
     """
+    seen = set()
+    unique_records = []
+    for record in input_data:
+        content = orjson.dumps(record, option=orjson.OPT_SORT_KEYS)
+        if content not in seen:
+            seen.add(content)
+            unique_records.append(record)
+    return unique_records
+
+# Set to have DocETL save each step's output for debugging (e.g. /dev/shm/docetl_intermediates keeps
+# it in tmpfs). Unset, extraction results stay in memory and nothing is written.
+DOCETL_INTERMEDIATE_DIR = os.getenv("DOCETL_INTERMEDIATE_DIR")
+
+@lru_cache(maxsize=None)
+def docetl_config_template(pipeline):
+    """
+    Build the static part of a pipeline's DocETL config (prompts, schemas, steps, output) once.
 
-    # Get pipeline-specific configuration
-    pipeline_config = get_pipeline_config(pipeline)
+    run_forensic_pipeline() adds the per-request "datasets" entry on top. The runner itself is
+    not reused: DSLRunner keeps loaded datasets and run state between runs.
 
-    # Save input data to temp file (DocETL requires file-based datasets)
-    input_path = "/tmp/forensic_input.json"
-    with open(input_path, 'w') as f:
-        json.dump(input_data, f)
+    Args:
+        pipeline: Pipeline name
 
-    # Get model configurations (with defaults)
+    Returns:
+        Config dict without "datasets", shared between calls; do not modify
+    """
+    pipeline_config = get_pipeline_config(pipeline)
     extraction_model = pipeline_config.get("extraction_model", "gpt-4o-mini")
-    analysis_model = pipeline_config.get("analysis_model", "gpt-4o-mini")
-
-    # Override analysis model if hybrid mode is enabled
-    if hybrid_mode:
-        analysis_model = "claude-sonnet-4-5-20250929"
-        print(f"[Pipeline] Hybrid mode enabled: Using {analysis_model} for analysis")
 
-    # Build DocETL config with pipeline-specific prompts and schemas
-    config = {
+    return {
         "default_model": "gpt-4o-mini",
         "system_prompt": {
             "dataset_description": pipeline_config["dataset_description"],
             "persona": pipeline_config["persona"]
         },
-        "datasets": {
-            "records": {
-                "type": "file",
-                "path": input_path
-            }
-        },
         "operations": [
             {
                 "name": "extract_events",
@@ -341,12 +1359,15 @@ def run_forensic_pipeline(input_data, pipeline="psych_timeline", hybrid_mode=Fal
                 "model": extraction_model,  # Use pipeline-specific extraction model
                 "prompt": pipeline_config["extraction_prompt"],
                 "output": {
-                    "schema": pipeline_config["output_schema"]
+                    "schema": pipeline_config["output_schema"],
+                    # Provider-side constrained decoding (json_schema response format) instead of a tool call
+                    "mode": "structured_output"
                 },
                 "validate": pipeline_config.get("extraction_validation", []),
                 "num_retries_on_validate_failure": pipeline_config.get("num_retries_on_validate_failure", 2),
                 "skip_on_error": True,  # Continue processing even if some records fail
-                "pass_through": True
+                "pass_through": True,
+                "litellm_completion_kwargs": extraction_completion_kwargs(pipeline_config)
             }
             # Note: No reduce operation - chronology assembly happens in Python after extraction
         ],
@@ -361,249 +1382,394 @@ def run_forensic_pipeline(input_data, pipeline="psych_timeline", hybrid_mode=Fal
             ],
             "output": {
                 "type": "file",
-                "path": "/tmp/forensic_analysis_output.json",
-                "intermediate_dir": "/tmp/docetl_intermediates"  # Save intermediate results for debugging
+                "path": "/tmp/forensic_analysis_output.json",  # Required by DocETL's schema; not written by run()
+                **({"intermediate_dir": DOCETL_INTERMEDIATE_DIR} if DOCETL_INTERMEDIATE_DIR else {})
             }
         }
     }
 
-    try:
-        print(f"[Pipeline] Analyzing {len(input_data)} records...")
-
-        # Run the pipeline (DSLRunner processes and saves to temp file)
-        runner = DSLRunner(config=config, max_threads=4, timeout_seconds=300)
-        runner.load_run_save()
-
-        print(f"[Pipeline] Pipeline execution complete")
-
-        # Read extraction results (map output)
-        extraction_path = "/tmp/docetl_intermediates/extraction/extract_events.json"
-        if os.path.exists(extraction_path):
-            with open(extraction_path, 'r') as f:
-                extracted_records = json.load(f)
-                extracted_count = len(extracted_records)
-                input_count = len(input_data)
-
-                # DATA INTEGRITY CHECK
-                if extracted_count < input_count:
-                    print(f"[WARNING] ⚠️  DATA LOSS: {input_count - extracted_count} records lost during extraction!")
-                    print(f"[WARNING]    Input: {input_count} records → Extracted: {extracted_count} records")
-                elif extracted_count > input_count:
-                    print(f"[WARNING] ⚠️  PHANTOM RECORDS: {extracted_count - input_count} extra records added!")
-                else:
-                    print(f"[Pipeline] ✓ Extraction integrity: {extracted_count}/{input_count} records")
-
-                # ============= PYTHON-BASED CHRONOLOGY ASSEMBLY =============
-                print(f"[Assembly] Assembling chronology from {extracted_count} extracted records...")
-
-                # Step 1: De-duplicate by record_id
-                seen_ids = set()
-                unique_records = []
-                duplicates_removed = 0
-
-                for record in extracted_records:
-                    record_id = record.get('record_id', '')
-                    if record_id and record_id in seen_ids:
-                        duplicates_removed += 1
-                        print(f"[Assembly] ⚠️  Removed duplicate record_id: {record_id}")
-                        continue
-                    seen_ids.add(record_id)
-                    unique_records.append(record)
-
-                if duplicates_removed > 0:
-                    print(f"[Assembly] Removed {duplicates_removed} duplicate(s)")
-                else:
-                    print(f"[Assembly] ✓ No duplicates found")
-
-                # Step 2: Sort by date
-                from datetime import datetime
-                invalid_dates = []  # Track records with invalid dates
-
-                def safe_parse_date(date_str):
-                    try:
-                        return datetime.strptime(date_str, '%Y-%m-%d')
-                    except:
-                        invalid_dates.append(date_str)
-                        print(f"[Assembly] ⚠️  Invalid date detected: '{date_str}'")
-                        return datetime.min  # Put invalid dates at the beginning
-
-                sorted_records = sorted(unique_records, key=lambda r: safe_parse_date(r.get('date', '')))
-                print(f"[Assembly] ✓ Sorted {len(sorted_records)} records by date")
-
-                if invalid_dates:
-                    print(f"[Assembly] ⚠️  Found {len(invalid_dates)} invalid date(s)")
-
-                # Step 3: Calculate gaps (Python date math - no LLM hallucinations!)
-                missing_records = []
-                for i in range(len(sorted_records) - 1):
-                    try:
-                        date1 = datetime.strptime(sorted_records[i]['date'], '%Y-%m-%d')
-                        date2 = datetime.strptime(sorted_records[i+1]['date'], '%Y-%m-%d')
-                        gap_days = (date2 - date1).days
-
-                        if gap_days > 30:
-                            missing_records.append(
-                                f"Gap detected: {sorted_records[i]['date']} to {sorted_records[i+1]['date']} "
-                                f"({gap_days} days) - No documented care between visits"
-                            )
-                    except Exception as e:
-                        print(f"[Assembly] Warning: Could not calculate gap between records: {e}")
-
-                print(f"[Assembly] ✓ Identified {len(missing_records)} gaps > 30 days")
-
-                # Step 4: Format chronology strings using standard event schema
-                # All pipelines extract to: date, record_id, event_type, event_description, provider
-                # Optional fields (confidence, diagnosis) are pipeline-specific
-                chronology = []
-                for record in sorted_records:
-                    entry = (
-                        f"{record.get('date', 'Unknown')} [{record.get('record_id', 'Unknown')}]: "
-                        f"[{record.get('event_type', 'unknown')}] - "
-                        f"{record.get('event_description', 'No description')} "
-                        f"(Provider: {record.get('provider', 'Unknown')})"
-                    )
+# Large record sets are split into contiguous shards, each run by its own DSLRunner in parallel
+# (each runner uses 4 threads). Threads rather than processes: the work is waiting on LLM calls,
+# and each shard records its usage in this process's cost tracker.
+DOCETL_SHARD_SIZE = 200
+DOCETL_MAX_SHARDS = 8
 
-                    # Append optional fields if present (e.g., confidence for medical_chronology)
-                    if 'confidence' in record:
-                        entry += f" [Confidence: {record.get('confidence', 'unknown')}]"
-
-                    chronology.append(entry)
-
-                print(f"[Assembly] ✓ Formatted {len(chronology)} chronology entries")
-                print(f"[Assembly] ✓ Final count: {len(chronology)} entries from {extracted_count} extracted records")
-
-                # Step 5: Flag records with invalid dates as documentation gaps
-                red_flags = []
-                contradictions = []
-                expert_opinions_needed = []
-
-                # Check if pipeline expects structured red_flags
-                analysis_schema = pipeline_config.get("analysis_schema", {})
-                use_structured_red_flags = analysis_schema.get("red_flags") == "list[dict]"
-
-                # Add invalid date records to red flags
-                for record in sorted_records:
-                    if record.get('date', '') in invalid_dates:
-                        if use_structured_red_flags:
-                            # Structured object format
-                            red_flags.append({
-                                "category": "documentation_gap",
-                                "issue": f"Record missing valid date '{record.get('date', '')}'",
-                                "records": [record.get('record_id', 'Unknown')],
-                                "legal_relevance": "high"
-                            })
-                        else:
-                            # Legacy pipe-delimited string format
-                            red_flags.append(
-                                f"Category: documentation_gap | Issue: Record missing valid date '{record.get('date', '')}' | "
-                                f"Record: {record.get('record_id', 'Unknown')} | Legal Relevance: high"
-                            )
-
-                if red_flags:
-                    print(f"[Assembly] ⚠️  Added {len(red_flags)} documentation gap(s) to red flags")
-
-                # Step 6: Optional LLM analysis for deeper insights (if pipeline requires it)
-                if pipeline_config.get("requires_llm_analysis", False):
-                    print(f"[Pipeline] Running LLM analysis with {analysis_model}...")
-                    analysis_results = analyze_records_for_red_flags(sorted_records, analysis_model, pipeline_config)
-
-                    # Merge LLM-generated insights with existing red flags
-                    llm_red_flags = analysis_results.get("red_flags", [])
-                    contradictions = analysis_results.get("contradictions", [])
-                    expert_opinions_needed = analysis_results.get("expert_opinions_needed", [])
-
-                    if llm_red_flags:
-                        red_flags.extend(llm_red_flags)
-                        print(f"[Analysis] ✓ Added {len(llm_red_flags)} LLM-detected red flag(s)")
-                else:
-                    print(f"[Pipeline] Skipping LLM analysis: Pipeline uses deterministic Python assembly only")
-
-                # Assemble final output
-                analysis_output = {
-                    "chronology": chronology,
-                    "missing_records": missing_records,
-                    "red_flags": red_flags,
-                    "contradictions": contradictions,  # LLM-detected contradictions (if hybrid mode)
-                    "expert_opinions_needed": expert_opinions_needed  # Areas needing expert review (if hybrid mode)
-                }
+def _run_docetl_shard(records, pipeline, shard_index=None, run_id=None):
+    """
+    Run the DocETL extraction pipeline on one batch of records and return the extracted rows.
+    The runner's token and cost totals are recorded for run_id as one extraction call.
+    """
+    template = docetl_config_template(pipeline)
+
+    # Pipeline-specific template plus these records as an in-memory dataset: no temp file round-trip,
+    # and DocETL's checkpoint hash covers the records themselves (a file dataset is hashed by path only)
+    config = {
+        **template,
+        "datasets": {
+            "records": {
+                "type": "memory",
+                "path": records
+            }
+        }
+    }
+    if shard_index is not None and DOCETL_INTERMEDIATE_DIR:
+        # Shards must not share a checkpoint directory
+        output = {**template["pipeline"]["output"], "intermediate_dir": os.path.join(DOCETL_INTERMEDIATE_DIR, f"shard_{shard_index}")}
+        config["pipeline"] = {**template["pipeline"], "output": output}
+
+    # Run the pipeline in memory (run() returns the output rows instead of saving them)
+    runner = DSLRunner(config=config, max_threads=4, timeout_seconds=300)
+    extracted_records, _ = runner.run()
+
+    usage = {
+        "prompt_tokens": sum(tokens.get("prompt_tokens", 0) for tokens in runner.total_token_usage.values()),
+        "completion_tokens": sum(tokens.get("completion_tokens", 0) for tokens in runner.total_token_usage.values())
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    record_llm_usage(run_id, "extraction", template["operations"][0]["model"], usage, runner.total_cost)
+    return extracted_records
+
+def run_docetl_extraction(records, pipeline, run_id=None):
+    """
+    Run DocETL extraction, in parallel shards for large record sets
+
+    Args:
+        records: List of document records
+        pipeline: Pipeline name
+        run_id: Cost tracker run the extraction's usage is recorded for (see start_cost_run)
+
+    Returns:
+        Extracted records, in input order
+    """
+    shard_count = min(DOCETL_MAX_SHARDS, -(-len(records) // DOCETL_SHARD_SIZE))
+    if shard_count <= 1:
+        return _run_docetl_shard(records, pipeline, run_id=run_id)
 
-                # Aggregate cost data from LiteLLM callbacks (separate extraction and analysis)
-                extraction_cost = 0.0
-                analysis_cost = 0.0
-                total_cost = 0.0
-                total_tokens = 0
-                llm_calls_count = 0
-
-                with _cost_tracker["lock"]:
-                    llm_calls_count = len(_cost_tracker["calls"])
-
-                    for call in _cost_tracker["calls"]:
-                        call_cost = call["cost"]
-                        total_cost += call_cost
-                        total_tokens += call["total_tokens"]
-
-                        # Separate extraction vs analysis costs
-                        operation = call.get("operation", "unknown")
-                        if operation == "analysis":
-                            analysis_cost += call_cost
-                        else:
-                            extraction_cost += call_cost
-
-                    # Reset tracker for next run
-                    _cost_tracker["calls"] = []
-
-                # Log cost summary
-                if total_cost > 0:
-                    print(f"[Pipeline] Total Cost: {llm_calls_count} LLM calls, ${total_cost:.4f} ({total_tokens:,} tokens)")
-                    if extraction_cost > 0:
-                        print(f"[Pipeline]   - Extraction: ${extraction_cost:.4f}")
-                    if analysis_cost > 0:
-                        print(f"[Pipeline]   - Analysis: ${analysis_cost:.4f}")
-
-                # Determine actual analysis model used
-                actual_analysis_model = analysis_model if pipeline_config.get("requires_llm_analysis", False) else "python"
-
-                cost_breakdown = {
+    shard_len = -(-len(records) // shard_count)
+    shards = [records[start:start + shard_len] for start in range(0, len(records), shard_len)]
+    logger.info("[Pipeline] Running extraction in %s parallel shards of up to %s records", len(shards), shard_len)
+
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="docetl-shard") as pool:
+        futures = [pool.submit(_run_docetl_shard, shard, pipeline, i, run_id) for i, shard in enumerate(shards)]
+        return [record for future in futures for record in future.result()]
+
+def run_forensic_pipeline(input_data, pipeline="psych_timeline", hybrid_mode=False, batch_mode=False):
+    """
+    Universal Forensic Discovery Pipeline
+    Uses DocETL to analyze documents
+
+    Args:
+        input_data: List of document records (JSON objects)
+        pipeline: One of "psych_timeline", "psych_expert_witness", "medical_chronology"
+        hybrid_mode: If True, uses Claude Sonnet 4 for analysis (higher quality, higher cost)
+        batch_mode: If True, extraction runs as a provider Batch API job (about half the cost, results
+            within 24h); for non-interactive runs only
+
+    Returns:
+        Dict with "analysis" and "cost_data" keys
+    """
+
+    # Get pipeline-specific configuration
+    pipeline_config = get_pipeline_config(pipeline)
+
+    # Get model configurations (with defaults)
+    extraction_model = pipeline_config.get("extraction_model", "gpt-4o-mini")
+    analysis_model = pipeline_config.get("analysis_model", "gpt-4o-mini")
+
+    # Override analysis model if hybrid mode is enabled
+    if hybrid_mode:
+        analysis_model = "claude-sonnet-4-5-20250929"
+        logger.info("[Pipeline] Hybrid mode enabled: Using %s for analysis", analysis_model)
+
+    # Batch jobs send the same calls as the direct backend
+    extraction_backend = "litellm" if batch_mode else pipeline_config.get("extraction_backend", EXTRACTION_BACKEND)
+
+    # Identical inputs through an identical pipeline: reuse the stored analysis
+    if PIPELINE_CACHE_ENABLED:
+        cache_key = pipeline_cache_key(
+            input_data, pipeline, analysis_model, extraction_backend, extraction_completion_kwargs(pipeline_config)
+        )
+        cached_analysis = load_cached_analysis(cache_key)
+        if cached_analysis is not None:
+            logger.info("[Pipeline] ✓ Cache hit (%s): reusing analysis, no LLM calls made", cache_key)
+            return {
+                "analysis": cached_analysis,
+                "cost_data": {
                     "extraction_model": extraction_model,
-                    "analysis_model": actual_analysis_model,  # Shows actual model used
-                    "extraction_cost": extraction_cost,
-                    "analysis_cost": analysis_cost,
-                    "total_cost": total_cost,
-                    "total_tokens": total_tokens,
-                    "records_processed": len(input_data)
+                    "analysis_model": analysis_model if pipeline_config.get("requires_llm_analysis", False) else "python",
+                    "extraction_cost": 0.0,
+                    "analysis_cost": 0.0,
+                    "total_cost": 0.0,
+                    "total_tokens": 0,
+                    "records_processed": len(input_data),
+                    "cache_hit": True
                 }
+            }
 
-                return {
-                    "analysis": analysis_output,
-                    "cost_data": cost_breakdown
-                }
+    run_id = start_cost_run()
+    analysis_future = None
+
+    try:
+        logger.info("[Pipeline] Analyzing %s records...", len(input_data))
+
+        # Identical documents (re-uploads, repeated chart pages) are extracted once; their copies
+        # would only be removed again by the record_id de-duplication below
+        extraction_input = unique_input_records(input_data)
+        if len(extraction_input) < len(input_data):
+            logger.info("[Pipeline] Skipping %s duplicate input record(s)", len(input_data) - len(extraction_input))
+
+        llm_cache_hits = 0
+        if batch_mode:
+            extracted_records, llm_cache_hits = extract_records_batch_api(extraction_input, pipeline_config, extraction_model, run_id)
+        elif extraction_backend == "litellm":
+            extracted_records, llm_cache_hits = extract_records_direct(extraction_input, pipeline_config, extraction_model, run_id)
+        else:
+            if pipeline_config.get("extraction_model_simple"):
+                logger.info("[Pipeline] extraction_model_simple is not used by the DocETL backend; "
+                            "all records go to %s", extraction_model)
+            extracted_records = run_docetl_extraction(extraction_input, pipeline, run_id)
+
+        logger.info("[Pipeline] Pipeline execution complete")
+
+        # Extraction results (map output) come back in memory
+        extracted_count = len(extracted_records)
+        input_count = len(extraction_input)
+
+        # DATA INTEGRITY CHECK
+        if extracted_count < input_count:
+            logger.warning("[WARNING] ⚠️  DATA LOSS: %s records lost during extraction!", input_count - extracted_count)
+            logger.warning("[WARNING]    Input: %s records → Extracted: %s records", input_count, extracted_count)
+        elif extracted_count > input_count:
+            logger.warning("[WARNING] ⚠️  PHANTOM RECORDS: %s extra records added!", extracted_count - input_count)
+        else:
+            logger.info("[Pipeline] ✓ Extraction integrity: %s/%s records", extracted_count, input_count)
+
+        # Drop the raw document fields carried over from the input: assembly and analysis only read
+        # extracted fields, and the raw text would otherwise be hashed into the analysis cache key
+        keep_fields = extracted_record_fields(pipeline)
+        if keep_fields is not None:
+            extracted_records = [
+                {field: record[field] for field in keep_fields if field in record}
+                for record in extracted_records
+            ]
+
+        # ============= PYTHON-BASED CHRONOLOGY ASSEMBLY =============
+        logger.info("[Assembly] Assembling chronology from %s extracted records...", extracted_count)
+
+        # Step 1: De-duplicate by record_id
+        seen_ids = set()
+        unique_records = []
+        duplicate_ids = []
+
+        for record in extracted_records:
+            record_id = record.get('record_id', '')
+            if record_id and record_id in seen_ids:
+                duplicate_ids.append(record_id)
+                continue
+            seen_ids.add(record_id)
+            unique_records.append(record)
+
+        if duplicate_ids:
+            logger.warning("[Assembly] ⚠️  Removed %s duplicate(s): %s%s", len(duplicate_ids),
+                           ", ".join(map(str, duplicate_ids[:5])), ", ..." if len(duplicate_ids) > 5 else "")
+        else:
+            logger.info("[Assembly] ✓ No duplicates found")
+
+        # Step 2: Sort by date
+        dates = parse_record_dates([record.get('date', '') for record in unique_records])
+
+        # Stable sort on the int64 view: NaT is the minimum int64, so invalid dates come first
+        order = np.argsort(dates.view("i8"), kind="stable")
+        sorted_records = [unique_records[i] for i in order]
+        sorted_dates = dates[order]
+        invalid_mask = np.isnat(sorted_dates)
+        logger.info("[Assembly] ✓ Sorted %s records by date", len(sorted_records))
+
+        invalid_indices = np.flatnonzero(invalid_mask)
+        if len(invalid_indices):
+            sample_dates = [repr(sorted_records[i].get('date', '')) for i in invalid_indices[:5]]
+            logger.warning("[Assembly] ⚠️  Found %s invalid date(s): %s%s", len(invalid_indices),
+                           ", ".join(sample_dates), ", ..." if len(invalid_indices) > 5 else "")
+
+        # Step 6 starts here: the LLM analysis only needs the sorted records, so its call runs on a
+        # worker thread while steps 3-5 assemble the chronology
+        if pipeline_config.get("requires_llm_analysis", False):
+            logger.info("[Pipeline] Running LLM analysis with %s...", analysis_model)
+            analysis_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis")
+            analysis_future = analysis_pool.submit(analyze_records_for_red_flags, sorted_records, analysis_model, pipeline_config, run_id)
+            analysis_pool.shutdown(wait=False)
+
+        # Step 3: Calculate gaps between consecutive valid dates (Python date math - no LLM hallucinations!)
+        valid_indices = np.flatnonzero(~invalid_mask)
+        gap_days = np.diff(sorted_dates[valid_indices]).astype(np.int64)
+        missing_records = []
+        for gap_index in np.flatnonzero(gap_days > 30):
+            record1 = sorted_records[valid_indices[gap_index]]
+            record2 = sorted_records[valid_indices[gap_index + 1]]
+            missing_records.append(
+                f"Gap detected: {record1['date']} to {record2['date']} "
+                f"({gap_days[gap_index]} days) - No documented care between visits"
+            )
+
+        logger.info("[Assembly] ✓ Identified %s gaps > 30 days", len(missing_records))
+
+        # Steps 4 and 5 (one pass over the sorted records):
+        # format chronology strings and flag records with invalid dates as documentation gaps
+        chronology = []
+        red_flags = []
+        contradictions = []
+        expert_opinions_needed = []
+
+        # Check if pipeline expects structured red_flags
+        analysis_schema = pipeline_config.get("analysis_schema", {})
+        use_structured_red_flags = analysis_schema.get("red_flags") == "list[dict]"
+
+        for record, date_invalid in zip(sorted_records, invalid_mask.tolist()):
+            # Step 4: Chronology entry using standard event schema
+            # All pipelines extract to: date, record_id, event_type, event_description, provider
+            # Optional fields (confidence, diagnosis) are pipeline-specific
+            entry = (
+                f"{record.get('date', 'Unknown')} [{record.get('record_id', 'Unknown')}]: "
+                f"[{record.get('event_type', 'unknown')}] - "
+                f"{record.get('event_description', 'No description')} "
+                f"(Provider: {record.get('provider', 'Unknown')})"
+            )
+
+            # Append optional fields if present (e.g., confidence for medical_chronology)
+            if 'confidence' in record:
+                entry += f" [Confidence: {record.get('confidence', 'unknown')}]"
+
+            chronology.append(entry)
+
+            # Step 5: Invalid date -> documentation gap red flag
+            if date_invalid:
+                if use_structured_red_flags:
+                    # Structured object format
+                    red_flags.append({
+                        "category": "documentation_gap",
+                        "issue": f"Record missing valid date '{record.get('date', '')}'",
+                        "records": [record.get('record_id', 'Unknown')],
+                        "legal_relevance": "high"
+                    })
+                else:
+                    # Legacy pipe-delimited string format
+                    red_flags.append(
+                        f"Category: documentation_gap | Issue: Record missing valid date '{record.get('date', '')}' | "
+                        f"Record: {record.get('record_id', 'Unknown')} | Legal Relevance: high"
+                    )
+
+        logger.info("[Assembly] ✓ Formatted %s chronology entries", len(chronology))
+        logger.info("[Assembly] ✓ Final count: %s entries from %s extracted records", len(chronology), extracted_count)
+
+        if red_flags:
+            logger.warning("[Assembly] ⚠️  Added %s documentation gap(s) to red flags", len(red_flags))
+
+        # Step 6: Optional LLM analysis for deeper insights (if pipeline requires it)
+        analysis_failed = False
+        if analysis_future is not None:
+            analysis_results = analysis_future.result()
+            if analysis_results is None:
+                # Already logged; the run returns without LLM findings and isn't cached
+                analysis_failed = True
+                analysis_results = {}
+
+            # Merge LLM-generated insights with existing red flags
+            llm_red_flags = analysis_results.get("red_flags", [])
+            contradictions = analysis_results.get("contradictions", [])
+            expert_opinions_needed = analysis_results.get("expert_opinions_needed", [])
+
+            if llm_red_flags:
+                red_flags.extend(llm_red_flags)
+                logger.info("[Analysis] ✓ Added %s LLM-detected red flag(s)", len(llm_red_flags))
         else:
-            # Extraction file not found - raise error
-            print(f"[ERROR] Extraction results not found at {extraction_path}")
-            raise FileNotFoundError(f"Extraction results not found at {extraction_path}")
+            logger.info("[Pipeline] Skipping LLM analysis: Pipeline uses deterministic Python assembly only")
+
+        # Assemble final output (contradictions and expert opinions come from the LLM analysis, if any)
+        analysis_output = empty_analysis(
+            chronology=chronology,
+            missing_records=missing_records,
+            red_flags=red_flags,
+            contradictions=contradictions,
+            expert_opinions_needed=expert_opinions_needed
+        )
+
+        # Aggregate the cost tracker's records for this run (separate extraction and analysis)
+        extraction_cost = 0.0
+        analysis_cost = 0.0
+        total_cost = 0.0
+        total_tokens = 0
+
+        # This run's calls only (runs overlap on the server's threadpool)
+        calls = drain_cost_calls(run_id)
+        llm_calls_count = len(calls)
+
+        extraction_cost_by_model = {}
+        for call in calls:
+            call_cost = call["cost"]
+            total_cost += call_cost
+            total_tokens += call["total_tokens"]
+
+            # Separate extraction vs analysis costs
+            operation = call.get("operation", "unknown")
+            if operation == "analysis":
+                analysis_cost += call_cost
+            else:
+                extraction_cost += call_cost
+                extraction_cost_by_model[call["model"]] = extraction_cost_by_model.get(call["model"], 0.0) + call_cost
+
+        # Log cost summary
+        if total_cost > 0:
+            logger.info("[Pipeline] Total Cost: %s LLM calls, $%.4f (%s tokens)", llm_calls_count, total_cost, f"{total_tokens:,}")
+            if extraction_cost > 0:
+                logger.info("[Pipeline]   - Extraction: $%.4f", extraction_cost)
+                if len(extraction_cost_by_model) > 1:
+                    for model, model_cost in extraction_cost_by_model.items():
+                        logger.info("[Pipeline]       %s: $%.4f", model, model_cost)
+            if analysis_cost > 0:
+                logger.info("[Pipeline]   - Analysis: $%.4f", analysis_cost)
+
+        # Determine actual analysis model used
+        actual_analysis_model = analysis_model if pipeline_config.get("requires_llm_analysis", False) else "python"
+
+        cost_breakdown = {
+            "extraction_model": extraction_model,
+            "analysis_model": actual_analysis_model,  # Shows actual model used
+            "extraction_cost": extraction_cost,
+            "extraction_cost_by_model": extraction_cost_by_model,  # Shows the split when simple records are routed
+            "analysis_cost": analysis_cost,
+            "total_cost": total_cost,
+            "total_tokens": total_tokens,
+            "llm_cache_hits": llm_cache_hits,  # Extraction calls answered from the LLM response cache
+            "records_processed": len(input_data)
+        }
+
+        # Only cache complete runs; records skipped or an analysis lost to transient LLM errors should
+        # be retried next time
+        if PIPELINE_CACHE_ENABLED and extracted_count == input_count and not analysis_failed:
+            save_cached_analysis(cache_key, analysis_output)
+
+        return {
+            "analysis": analysis_output,
+            "cost_data": cost_breakdown
+        }
 
     except Exception as e:
-        print(f"[Pipeline Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Pipeline Error] %s", e)
+
+        # A failure after the analysis was submitted: let its call finish (or cancel it if it hasn't
+        # started), so its cost is counted here rather than landing after the drain below
+        if analysis_future is not None and not analysis_future.cancel():
+            wait([analysis_future])
 
         # Capture any costs incurred before error
         total_cost = 0.0
         total_tokens = 0
-        with _cost_tracker["lock"]:
-            for call in _cost_tracker["calls"]:
-                total_cost += call["cost"]
-                total_tokens += call["total_tokens"]
-            _cost_tracker["calls"] = []
+        for call in drain_cost_calls(run_id):
+            total_cost += call["cost"]
+            total_tokens += call["total_tokens"]
 
         # Return error with any cost data captured
-        error_analysis = {
-            "chronology": [],
-            "missing_records": [f"Pipeline error: {str(e)}"],
-            "red_flags": [],
-            "contradictions": [],
-            "expert_opinions_needed": []
-        }
+        error_analysis = empty_analysis(missing_records=[f"Pipeline error: {str(e)}"])
         error_cost_data = {
             "extraction_model": extraction_model if 'extraction_model' in locals() else "unknown",
             "analysis_model": "python",
@@ -1,12 +1,85 @@
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from typing import List, Any, Optional
+import msgspec
 import uvicorn
+import atexit
+import io
+import logging
+import orjson
 import os
+import queue
+import urllib.parse
+from logging.handlers import QueueHandler, QueueListener
+
+# Backend modules log through `logging` with their own "[Component]" prefixes.
+# Set LOG_LEVEL=WARNING in production to skip info-level formatting entirely.
+# Records go through a queue to a listener thread that writes them, so request handlers and LLM
+# worker threads never block on stderr.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s", handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+
+def dump_json(content: Any) -> bytes:
+    """Serialize a response payload: orjson, with str() for anything it has no native encoding for"""
+    return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+class ORJSONResponse(Response):
+    """
+    JSON response serialized with orjson. Handlers with large payloads (analysis results, case
+    lists) return it directly, which also skips FastAPI's jsonable_encoder pass; dicts returned
+    from other handlers are rendered with it as the app's default response class.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+def json_ok(**fields):
+    """Success payload as a pre-serialized response (no response model, no jsonable_encoder pass)"""
+    return ORJSONResponse({"status": "success", **fields})
 
-app = FastAPI()
+def json_ok_streamed(sections_key, sections, **fields):
+    """
+    Success payload with one large dict field (e.g. a full analysis) streamed a section at a time,
+    so the body is never held as a single serialized buffer. Same JSON as json_ok would produce.
+    """
+    def body():
+        head = dump_json({"status": "success", **fields})
+        yield head[:-1] + b"," + orjson.dumps(sections_key) + b":{"
+        for i, (key, value) in enumerate(sections.items()):
+            yield (b"," if i else b"") + orjson.dumps(key) + b":" + dump_json(value)
+        yield b"}}"
+
+    return StreamingResponse(body(), media_type=ORJSONResponse.media_type)
+
+async def render_pdf(*args, **kwargs) -> bytes:
+    """
+    Run generate_forensic_pdf into memory on a worker thread: reportlab's build is CPU-bound and
+    would otherwise block the event loop, and concurrent exports don't share a /tmp file
+    """
+    from pdf_generator import generate_forensic_pdf
+    buffer = io.BytesIO()
+    await run_in_threadpool(generate_forensic_pdf, *args, buffer, **kwargs)
+    return buffer.getvalue()
+
+def pdf_response(pdf_bytes: bytes, filename: str) -> Response:
+    """PDF download, with the Content-Disposition FileResponse(filename=...) would send"""
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        disposition = f'attachment; filename="{filename}"'
+    return Response(pdf_bytes, media_type="application/pdf", headers={"Content-Disposition": disposition})
 
 # VERY IMPORTANT: This allows your Next.js app to talk to Python
 app.add_middleware(
@@ -29,35 +102,48 @@ def list_pipelines_endpoint():
     from pipeline_configs import list_pipelines
     return {"pipelines": list_pipelines()}
 
-class ProcessRequest(BaseModel):
+# Request bodies are msgspec Structs, decoded and validated straight from the raw body in one pass
+# (msgspec_body), instead of FastAPI parsing the JSON and Pydantic then walking and copying it.
+# /process bodies carry every uploaded record, so this is most of the request-parsing cost.
+def msgspec_body(struct_type):
+    """Dependency that decodes the request body as struct_type; malformed or invalid bodies get a 422"""
+    async def decode_body(request: Request):
+        try:
+            # strict=False coerces e.g. "5" to 5, like Pydantic's default lax mode
+            return msgspec.json.decode(await request.body(), type=struct_type, strict=False)
+        except msgspec.DecodeError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    return decode_body
+
+class ProcessRequest(msgspec.Struct):
     records: List[dict]
     pipeline: str = "psych_timeline"  # Default to basic timeline
     customer_name: Optional[str] = "Confidential Client"
     customer_email: Optional[str] = ""
     hybrid_mode: Optional[bool] = False  # Use Claude for analysis, GPT-4o-mini for extraction
 
-class ExportPDFRequest(BaseModel):
+class ExportPDFRequest(msgspec.Struct):
     analysis: dict
     customer_name: Optional[str] = "Confidential Client"
     pipeline: str = "psych_timeline"
     records_analyzed: int = 0
 
-class UpdateEditsRequest(BaseModel):
+class UpdateEditsRequest(msgspec.Struct):
     case_id: str
     edits: dict
     comments: Optional[dict] = None
 
-class UpdateStatusRequest(BaseModel):
+class UpdateStatusRequest(msgspec.Struct):
     case_id: str
     status: str
 
-class ChatRequest(BaseModel):
+class ChatRequest(msgspec.Struct):
     case_id: str
     message: str
     history: List[dict] = []  # List of {role: str, content: str}
 
 @app.post("/process")
-async def process_data(request: ProcessRequest):
+async def process_data(request: ProcessRequest = Depends(msgspec_body(ProcessRequest))):
     """
     Universal Forensic Discovery Endpoint
     Receives documents and returns pipeline-specific forensic analysis
@@ -74,11 +160,9 @@ async def process_data(request: ProcessRequest):
     customer_email = request.customer_email
     hybrid_mode = request.hybrid_mode
 
-    print(f"\n{'='*60}")
-    print(f"[API] Received {len(records)} records for {pipeline} analysis")
+    logger.info("[API] Received %s records for %s analysis", len(records), pipeline)
     if hybrid_mode:
-        print(f"[API] Hybrid mode enabled: Claude Sonnet 4 for analysis")
-    print(f"{'='*60}\n")
+        logger.info("[API] Hybrid mode enabled: Claude Sonnet 4 for analysis")
 
     # Import the pipeline
     try:
@@ -86,7 +170,7 @@ async def process_data(request: ProcessRequest):
         from pipeline_configs import get_pipeline_config
         from case_manager import create_case, update_case_analysis
     except Exception as import_error:
-        print(f"[API Error] Failed to import pipeline: {import_error}")
+        logger.exception("[API Error] Failed to import pipeline: %s", import_error)
         return {
             "status": "error",
             "error": f"Pipeline import failed: {str(import_error)}",
@@ -96,7 +180,7 @@ async def process_data(request: ProcessRequest):
     # Validate pipeline
     try:
         pipeline_config = get_pipeline_config(pipeline)
-        print(f"[API] Using pipeline: {pipeline_config['name']}")
+        logger.info("[API] Using pipeline: %s", pipeline_config['name'])
     except ValueError as e:
         return {
             "status": "error",
@@ -105,13 +189,15 @@ async def process_data(request: ProcessRequest):
         }
 
     # Create case record
-    case_id = create_case(customer_name, customer_email, pipeline, len(records))
+    case_id = await run_in_threadpool(create_case, customer_name, customer_email, pipeline, len(records))
 
     # Run the DocETL pipeline
     try:
-        print("[API] Starting pipeline execution...")
-        result = run_forensic_pipeline(records, pipeline=pipeline, hybrid_mode=hybrid_mode)
-        print(f"[API] Pipeline returned: {result}")
+        logger.info("[API] Starting pipeline execution...")
+        # The pipeline blocks for the whole run (extraction has its own event loop on the worker
+        # thread); running it here would stall every other request until it finished
+        result = await run_in_threadpool(run_forensic_pipeline, records, pipeline=pipeline, hybrid_mode=hybrid_mode)
+        logger.debug("[API] Pipeline returned: %s", result)
 
         # Extract analysis and cost data from result
         if "cost_data" in result:
@@ -123,31 +209,28 @@ async def process_data(request: ProcessRequest):
             cost_data = None
 
         # Log analysis metrics (keys depend on pipeline)
-        print(f"\n[API] Analysis complete:")
-        for key, value in analysis.items():
-            if isinstance(value, list):
-                print(f"  - {key}: {len(value)} items")
-        print()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[API] Analysis complete: %s", ", ".join(
+                f"{key}: {len(value)} items" for key, value in analysis.items() if isinstance(value, list)
+            ))
 
         # Update case with analysis results and original records (for provenance)
-        update_case_analysis(case_id, analysis, original_records=records)
+        await run_in_threadpool(update_case_analysis, case_id, analysis, original_records=records)
 
         # Update case with cost data if available
         if cost_data:
             from case_manager import update_case_costs
-            update_case_costs(case_id, cost_data)
-
-        return {
-            "status": "success",
-            "case_id": case_id,
-            "pipeline": pipeline,
-            "records_analyzed": len(records),
-            "analysis": analysis
-        }
+            await run_in_threadpool(update_case_costs, case_id, cost_data)
+
+        return json_ok_streamed(
+            "analysis",
+            analysis,
+            case_id=case_id,
+            pipeline=pipeline,
+            records_analyzed=len(records)
+        )
     except Exception as e:
-        print(f"[API Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[API Error] %s", e)
         return {
             "status": "error",
             "error": str(e),
@@ -155,7 +238,7 @@ async def process_data(request: ProcessRequest):
         }
 
 @app.post("/export-pdf")
-async def export_pdf(request: ExportPDFRequest):
+async def export_pdf(request: ExportPDFRequest = Depends(msgspec_body(ExportPDFRequest))):
     """
     Export forensic analysis to PDF
 
@@ -166,7 +249,6 @@ async def export_pdf(request: ExportPDFRequest):
     - records_analyzed: Number of records processed
     """
     try:
-        from pdf_generator import generate_forensic_pdf
         from pipeline_configs import get_pipeline_config
 
         # Get pipeline config for proper title
@@ -184,25 +266,18 @@ async def export_pdf(request: ExportPDFRequest):
         }
 
         # Generate PDF
-        output_path = "/tmp/forensic_report.pdf"
-        generate_forensic_pdf(request.analysis, case_info, output_path)
+        pdf_bytes = await render_pdf(request.analysis, case_info)
 
-        return FileResponse(
-            output_path,
-            media_type="application/pdf",
-            filename=f"forensic_report_{request.customer_name.replace(' ', '_')}.pdf"
-        )
+        return pdf_response(pdf_bytes, f"forensic_report_{request.customer_name.replace(' ', '_')}.pdf")
 
     except Exception as e:
-        print(f"[PDF Export Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[PDF Export Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
-@app.get("/admin/cases")
+@app.get("/admin/cases", response_model=None)
 async def list_all_cases():
     """
     Admin endpoint: List all cases
@@ -212,21 +287,16 @@ async def list_all_cases():
     """
     try:
         from case_manager import list_cases
-        cases = list_cases()
-        return {
-            "status": "success",
-            "cases": cases
-        }
+        cases = await run_in_threadpool(list_cases)
+        return json_ok(cases=cases)
     except Exception as e:
-        print(f"[Admin Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Admin Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
-@app.get("/admin/case/{case_id}")
+@app.get("/admin/case/{case_id}", response_model=None)
 async def get_case_details(case_id: str):
     """
     Admin endpoint: Get case details
@@ -238,28 +308,27 @@ async def get_case_details(case_id: str):
         Full case record including analysis and edits
     """
     try:
-        from case_manager import get_case
-        case = get_case(case_id)
+        from case_manager import get_case, get_case_records_json
+        case = await run_in_threadpool(get_case, case_id, include_records=False)
         if case is None:
             return {
                 "status": "error",
                 "error": f"Case {case_id} not found"
             }
-        return {
-            "status": "success",
-            "case": case
-        }
+        # Source records go out as stored, without being parsed and re-serialized
+        records_json = await run_in_threadpool(get_case_records_json, case_id)
+        if records_json is not None:
+            case = {**case, "original_records": orjson.Fragment(records_json)}
+        return json_ok(case=case)
     except Exception as e:
-        print(f"[Admin Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Admin Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
 @app.post("/admin/update-edits")
-async def update_edits(request: UpdateEditsRequest):
+async def update_edits(request: UpdateEditsRequest = Depends(msgspec_body(UpdateEditsRequest))):
     """
     Admin endpoint: Update case edits and comments
 
@@ -273,22 +342,20 @@ async def update_edits(request: UpdateEditsRequest):
     """
     try:
         from case_manager import update_case_edits
-        update_case_edits(request.case_id, request.edits, request.comments)
+        await run_in_threadpool(update_case_edits, request.case_id, request.edits, request.comments)
         return {
             "status": "success",
             "message": f"Edits saved for case {request.case_id}"
         }
     except Exception as e:
-        print(f"[Admin Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Admin Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
 @app.post("/admin/update-status")
-async def update_status(request: UpdateStatusRequest):
+async def update_status(request: UpdateStatusRequest = Depends(msgspec_body(UpdateStatusRequest))):
     """
     Admin endpoint: Update case status
 
@@ -301,15 +368,13 @@ async def update_status(request: UpdateStatusRequest):
     """
     try:
         from case_manager import update_case_status
-        update_case_status(request.case_id, request.status)
+        await run_in_threadpool(update_case_status, request.case_id, request.status)
         return {
             "status": "success",
             "message": f"Case {request.case_id} marked as {request.status}"
         }
     except Exception as e:
-        print(f"[Admin Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Admin Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
@@ -327,12 +392,11 @@ async def export_case_pdf(case_id: str):
         PDF file
     """
     try:
-        from pdf_generator import generate_forensic_pdf
         from case_manager import get_case
         from pipeline_configs import get_pipeline_config
 
         # Get case
-        case = get_case(case_id)
+        case = await run_in_threadpool(get_case, case_id, include_records=False)
         if case is None:
             return {
                 "status": "error",
@@ -360,26 +424,56 @@ async def export_case_pdf(case_id: str):
         comments = case.get("comments", {})
 
         # Generate PDF with track changes
-        output_path = f"/tmp/forensic_report_{case_id}.pdf"
-        generate_forensic_pdf(edited_analysis, case_info, output_path, original_analysis=original_analysis, comments=comments)
+        pdf_bytes = await render_pdf(edited_analysis, case_info, original_analysis=original_analysis, comments=comments)
 
-        return FileResponse(
-            output_path,
-            media_type="application/pdf",
-            filename=f"forensic_report_{case['customer_name'].replace(' ', '_')}_{case_id}.pdf"
-        )
+        return pdf_response(pdf_bytes, f"forensic_report_{case['customer_name'].replace(' ', '_')}_{case_id}.pdf")
 
     except Exception as e:
-        print(f"[PDF Export Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[PDF Export Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
+# ============= Chat Context Budget =============
+# Prompt size drives chat latency and cost, so context and history are capped by token count.
+# Counts use litellm's bundled cl100k_base encoding: exact for OpenAI models, a close estimate for Claude.
+CHAT_CONTEXT_TOKEN_BUDGET = 8000
+CHAT_BULK_SECTIONS = ("chronology", "timeline")  # Trimmed first when context is over budget
+CHAT_HISTORY_MAX_TURNS = 10  # user/assistant exchanges
+CHAT_HISTORY_TOKEN_BUDGET = 4000
+
+def count_tokens(text: str) -> int:
+    """Approximate token count of text (special-token strings in user text are counted as plain text)"""
+    import litellm
+    return len(litellm.encoding.encode(text, disallowed_special=()))
+
+def trim_chat_history(history: List[dict]) -> List[dict]:
+    """
+    Most recent chat history that fits both CHAT_HISTORY_MAX_TURNS and CHAT_HISTORY_TOKEN_BUDGET,
+    oldest first. Never starts on an assistant message, so the conversation still opens with the user.
+    """
+    kept = []
+    budget = CHAT_HISTORY_TOKEN_BUDGET
+    for msg in reversed(history[-2 * CHAT_HISTORY_MAX_TURNS:]):
+        cost = count_tokens(str(msg["content"]))
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(msg)
+    kept.reverse()
+    while kept and kept[0]["role"] == "assistant":
+        kept.pop(0)
+    return kept
+
+def chat_context_item(item) -> str:
+    """Analysis item as chat context: strings as-is, structured items (list[dict] schemas) as compact JSON"""
+    if isinstance(item, (dict, list)):
+        return orjson.dumps(item).decode()
+    return str(item)
+
 @app.post("/chat")
-async def chat_with_case(request: ChatRequest):
+async def chat_with_case(request: ChatRequest = Depends(msgspec_body(ChatRequest))):
     """
     Chat with case analysis using structured ETL output as grounded context
 
@@ -396,7 +490,7 @@ async def chat_with_case(request: ChatRequest):
         import litellm
 
         # Get case
-        case = get_case(request.case_id)
+        case = await run_in_threadpool(get_case, request.case_id, include_records=False)
         if case is None:
             return {
                 "status": "error",
@@ -406,23 +500,32 @@ async def chat_with_case(request: ChatRequest):
         # Use edited version if available (expert-reviewed data)
         analysis = case.get("edits", case.get("analysis", {}))
 
-        # Build grounded context from ETL output
+        # Build grounded context from ETL output, within CHAT_CONTEXT_TOKEN_BUDGET.
+        # Findings sections claim the budget first; long event lists get what is left.
+        sections = [(key, value) for key, value in analysis.items() if isinstance(value, list) and value]
+        shown = {}
+        budget = CHAT_CONTEXT_TOKEN_BUDGET
+        for key, value in sorted(sections, key=lambda section: section[0] in CHAT_BULK_SECTIONS):
+            lines = []
+            for i, item in enumerate(value, 1):
+                line = f"{i}. {chat_context_item(item)}"
+                cost = count_tokens(line)
+                if cost > budget:
+                    break
+                budget -= cost
+                lines.append(line)
+            shown[key] = lines
+
+        # Add all available sections (dynamic based on pipeline), in analysis order
         context_parts = []
-
-        # Add all available sections (dynamic based on pipeline)
-        for key, value in analysis.items():
-            if not isinstance(value, list):
-                continue
-
-            # Limit chronology to first 100 events to avoid token limits
-            if key == "chronology" and len(value) > 100:
-                sample = value[:100]
-                context_parts.append(f"{key.upper().replace('_', ' ')} ({len(value)} total events, showing first {len(sample)}):")
-                context_parts.append("\n".join([str(item) for item in sample]))
-            elif value:  # Only add non-empty sections
-                context_parts.append(f"\n{key.upper().replace('_', ' ')} ({len(value)}):")
-                for i, item in enumerate(value, 1):
-                    context_parts.append(f"{i}. {item}")
+        for key, value in sections:
+            title = key.upper().replace('_', ' ')
+            lines = shown[key]
+            if len(lines) < len(value):
+                header = f"{title} ({len(value)} total, showing first {len(lines)}):"
+            else:
+                header = f"{title} ({len(value)}):"
+            context_parts.append("\n".join([header, *lines]))
 
         context = "\n\n".join(context_parts)
 
@@ -449,12 +552,11 @@ Do NOT speculate, infer, or add information beyond what's explicitly in the extr
             {"role": "system", "content": system_prompt}
         ]
 
-        # Add conversation history
-        for msg in request.history:
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        # Add conversation history (most recent turns, within the history budget)
+        messages.extend(
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in trim_chat_history(request.history)
+        )
 
         # Add current message
         messages.append({
@@ -462,29 +564,34 @@ Do NOT speculate, infer, or add information beyond what's explicitly in the extr
             "content": request.message
         })
 
-        # Call LLM
-        response = litellm.completion(
+        # Call LLM (async client: the event loop keeps serving other requests while it waits)
+        response = await litellm.acompletion(
             model="claude-sonnet-4-5-20250929",
             messages=messages,
-            temperature=0.1  # Low temperature for factual responses
+            temperature=0.1,  # Low temperature for factual responses
+            metadata={"operation": "chat"}  # No run_id: not billed to any pipeline run
         )
 
         answer = response.choices[0].message.content
 
-        return {
-            "status": "success",
-            "response": answer,
-            "case_id": request.case_id
-        }
+        return json_ok(
+            response=answer,
+            case_id=request.case_id
+        )
 
     except Exception as e:
-        print(f"[Chat Error] {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Chat Error] %s", e)
         return {
             "status": "error",
             "error": str(e)
         }
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    # Development: one auto-reloading process. Production: set WEB_CONCURRENCY to run that many
+    # worker processes, so a CPU-bound request (PDF build, analysis assembly) can't stall the rest.
+    # Case writes are safe across workers (see case_manager._case_write_lock).
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=8001, workers=workers)
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
@@ -10,6 +10,167 @@ from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from datetime import datetime
+from html import escape
+
+
+# ============= Styles =============
+# Built once at import: the sample stylesheet and ParagraphStyle/HexColor
+# construction are the same for every report.
+
+_STYLES = getSampleStyleSheet()
+
+EMERALD = colors.HexColor('#059669')
+SLATE = colors.HexColor('#64748b')
+DARK_SLATE = colors.HexColor('#1e293b')
+BODY_TEXT = colors.HexColor('#334155')
+BORDER_GRAY = colors.HexColor('#e2e8f0')
+HEADER_BG = colors.HexColor('#f8fafc')
+RED = colors.HexColor('#dc2626')
+AMBER = colors.HexColor('#d97706')
+BLUE = colors.HexColor('#2563eb')
+PURPLE = colors.HexColor('#7c3aed')
+
+TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_STYLES['Heading1'],
+    fontSize=24,
+    textColor=EMERALD,
+    spaceAfter=30,
+    alignment=TA_CENTER
+)
+
+SUBTITLE_STYLE = ParagraphStyle(
+    'CustomSubtitle',
+    parent=_STYLES['Normal'],
+    fontSize=12,
+    textColor=SLATE,
+    spaceAfter=20,
+    alignment=TA_CENTER
+)
+
+SECTION_HEADER_STYLE = ParagraphStyle(
+    'SectionHeader',
+    parent=_STYLES['Heading2'],
+    fontSize=14,
+    textColor=DARK_SLATE,
+    spaceAfter=12,
+    spaceBefore=20,
+    borderWidth=1,
+    borderColor=BORDER_GRAY,
+    borderPadding=8,
+    backColor=HEADER_BG
+)
+
+BODY_STYLE = ParagraphStyle(
+    'CustomBody',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=BODY_TEXT,
+    leading=14,
+    spaceAfter=8
+)
+
+ALERT_STYLE = ParagraphStyle(
+    'AlertStyle',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=RED,
+    leading=14,
+    spaceAfter=8
+)
+
+WARNING_STYLE = ParagraphStyle(
+    'WarningStyle',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=AMBER,
+    leading=14,
+    spaceAfter=8
+)
+
+# Track changes styles
+EDITED_STYLE = ParagraphStyle(
+    'EditedStyle',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=BLUE,
+    leading=14,
+    spaceAfter=8
+)
+
+ADDED_STYLE = ParagraphStyle(
+    'AddedStyle',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=EMERALD,
+    leading=14,
+    spaceAfter=8
+)
+
+COMMENT_STYLE = ParagraphStyle(
+    'CommentStyle',
+    parent=_STYLES['Normal'],
+    fontSize=9,
+    textColor=PURPLE,
+    leading=12,
+    spaceAfter=4,
+    leftIndent=20,
+    fontName='Helvetica-Oblique'
+)
+
+LEGEND_STYLE = ParagraphStyle(
+    'LegendStyle',
+    parent=_STYLES['Normal'],
+    fontSize=9,
+    textColor=SLATE,
+    leading=12,
+    spaceAfter=4
+)
+
+METADATA_TABLE_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('TEXTCOLOR', (0, 0), (0, -1), SLATE),
+    ('TEXTCOLOR', (1, 0), (1, -1), DARK_SLATE),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+])
+
+# Findings per multi-line Paragraph. Small groups: splitting a Paragraph across
+# pages re-wraps the remainder, so long ones lay out slower, not faster.
+ITEMS_PER_PARAGRAPH = 5
+
+# Map common analysis keys to sections
+_CRITICAL_SECTIONS = {
+    # Medical Chronology pipeline outputs
+    'chronology': ('MEDICAL CHRONOLOGY', BODY_STYLE, '●'),
+    'missing_records': ('MISSING RECORDS / GAPS IN CARE', ALERT_STYLE, '⚠'),
+    'red_flags': ('RED FLAGS', ALERT_STYLE, '⚠'),
+
+    # Common sections across all tiers
+    'timeline': ('TIMELINE', BODY_STYLE, '●'),
+    'treatment_gaps': ('TREATMENT GAPS', ALERT_STYLE, '⚠'),
+
+    # Compliance tier
+    'medication_adherence': ('MEDICATION ADHERENCE', BODY_STYLE, '●'),
+    'safety_documentation': ('SAFETY DOCUMENTATION', ALERT_STYLE, '⚠'),
+    'consent_issues': ('CONSENT ISSUES', WARNING_STYLE, '⚠'),
+
+    # Expert witness tier
+    'contradictions': ('CONTRADICTIONS', WARNING_STYLE, '⚠'),
+    'standard_of_care_deviations': ('STANDARD OF CARE DEVIATIONS', ALERT_STYLE, '⚠'),
+    'competency_timeline': ('COMPETENCY TIMELINE', BODY_STYLE, '●'),
+    'expert_opinions_needed': ('EXPERT OPINIONS NEEDED', BODY_STYLE, '●'),
+
+    # Full discovery tier
+    'functional_capacity_timeline': ('FUNCTIONAL CAPACITY TIMELINE', BODY_STYLE, '●'),
+    'suicide_violence_risk_assessment': ('SUICIDE/VIOLENCE RISK ASSESSMENT', ALERT_STYLE, '⚠'),
+    'substance_use_impact': ('SUBSTANCE USE IMPACT', BODY_STYLE, '●'),
+    'legal_psychiatric_interface': ('LEGAL-PSYCHIATRIC INTERFACE', BODY_STYLE, '●'),
+    'causation_analysis': ('CAUSATION ANALYSIS', BODY_STYLE, '●'),
+    'damages_assessment': ('DAMAGES ASSESSMENT', BODY_STYLE, '●'),
+}
 
 
 def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=None, comments=None):
@@ -19,12 +180,12 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
     Args:
         analysis: Analysis results dict (edited version)
         case_info: Dict with customer_name, domain, records_analyzed, etc.
-        output_path: Where to save the PDF
+        output_path: Where to save the PDF: a file path, or a binary file object such as io.BytesIO
         original_analysis: Original AI-generated analysis (for track changes)
         comments: Expert comments dict (optional)
 
     Returns:
-        Path to generated PDF
+        output_path
     """
     # Create PDF document
     doc = SimpleDocTemplate(
@@ -39,103 +200,11 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
     # Container for PDF elements
     story = []
 
-    # Define styles
-    styles = getSampleStyleSheet()
-
-    # Custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#059669'),  # Emerald
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-
-    subtitle_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Normal'],
-        fontSize=12,
-        textColor=colors.HexColor('#64748b'),  # Slate
-        spaceAfter=20,
-        alignment=TA_CENTER
-    )
-
-    section_header_style = ParagraphStyle(
-        'SectionHeader',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor('#1e293b'),  # Dark slate
-        spaceAfter=12,
-        spaceBefore=20,
-        borderWidth=1,
-        borderColor=colors.HexColor('#e2e8f0'),
-        borderPadding=8,
-        backColor=colors.HexColor('#f8fafc')
-    )
-
-    body_style = ParagraphStyle(
-        'CustomBody',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#334155'),
-        leading=14,
-        spaceAfter=8
-    )
-
-    alert_style = ParagraphStyle(
-        'AlertStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#dc2626'),  # Red
-        leading=14,
-        spaceAfter=8
-    )
-
-    warning_style = ParagraphStyle(
-        'WarningStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#d97706'),  # Amber
-        leading=14,
-        spaceAfter=8
-    )
-
-    # Track changes styles
-    edited_style = ParagraphStyle(
-        'EditedStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#2563eb'),  # Blue
-        leading=14,
-        spaceAfter=8
-    )
-
-    added_style = ParagraphStyle(
-        'AddedStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#059669'),  # Green
-        leading=14,
-        spaceAfter=8
-    )
-
-    comment_style = ParagraphStyle(
-        'CommentStyle',
-        parent=styles['Normal'],
-        fontSize=9,
-        textColor=colors.HexColor('#7c3aed'),  # Purple
-        leading=12,
-        spaceAfter=4,
-        leftIndent=20,
-        fontName='Helvetica-Oblique'
-    )
-
     # ===== HEADER =====
-    story.append(Paragraph("Document Analysis ~ Powered by FPA Med AI", title_style))
+    story.append(Paragraph("Document Analysis ~ Powered by FPA Med AI", TITLE_STYLE))
 
     domain_name = case_info.get('domain_name', 'Forensic Analysis')
-    story.append(Paragraph(domain_name, subtitle_style))
+    story.append(Paragraph(domain_name, SUBTITLE_STYLE))
 
     # Case metadata table
     metadata = [
@@ -145,35 +214,18 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
     ]
 
     metadata_table = Table(metadata, colWidths=[2*inch, 4*inch])
-    metadata_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('TEXTCOLOR', (0, 0), (0, -1), colors.HexColor('#64748b')),
-        ('TEXTCOLOR', (1, 0), (1, -1), colors.HexColor('#1e293b')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-    ]))
+    metadata_table.setStyle(METADATA_TABLE_STYLE)
 
     story.append(metadata_table)
     story.append(Spacer(1, 0.3*inch))
 
     # ===== TRACK CHANGES LEGEND (if original analysis provided) =====
     if original_analysis:
-        legend_style = ParagraphStyle(
-            'LegendStyle',
-            parent=styles['Normal'],
-            fontSize=9,
-            textColor=colors.HexColor('#64748b'),
-            leading=12,
-            spaceAfter=4
-        )
-
-        story.append(Paragraph("<b>Track Changes Legend:</b>", legend_style))
-        story.append(Paragraph("✓ AI-Generated (Validated by Expert)", body_style))
-        story.append(Paragraph("✏ Edited by Expert", edited_style))
-        story.append(Paragraph("✚ Added by Expert", added_style))
-        story.append(Paragraph("💬 Expert Comment/Rationale", comment_style))
+        story.append(Paragraph("<b>Track Changes Legend:</b>", LEGEND_STYLE))
+        story.append(Paragraph("✓ AI-Generated (Validated by Expert)", BODY_STYLE))
+        story.append(Paragraph("✏ Edited by Expert", EDITED_STYLE))
+        story.append(Paragraph("✚ Added by Expert", ADDED_STYLE))
+        story.append(Paragraph("💬 Expert Comment/Rationale", COMMENT_STYLE))
         story.append(Spacer(1, 0.2*inch))
 
     # ===== HELPER FUNCTION FOR TRACK CHANGES =====
@@ -202,47 +254,13 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
 
         status = get_change_status(section, index)
         if status == 'added':
-            return '✚', added_style
+            return '✚', ADDED_STYLE
         elif status == 'edited':
-            return '✏', edited_style
+            return '✏', EDITED_STYLE
         else:
             return '✓', default_style
 
     # ===== CRITICAL FINDINGS SECTIONS =====
-    # Determine which sections to show based on analysis keys
-    analysis_keys = list(analysis.keys())
-
-    # Map common analysis keys to sections
-    critical_sections = {
-        # Medical Chronology pipeline outputs
-        'chronology': ('MEDICAL CHRONOLOGY', body_style, '●'),
-        'missing_records': ('MISSING RECORDS / GAPS IN CARE', alert_style, '⚠'),
-        'red_flags': ('RED FLAGS', alert_style, '⚠'),
-
-        # Common sections across all tiers
-        'timeline': ('TIMELINE', body_style, '●'),
-        'treatment_gaps': ('TREATMENT GAPS', alert_style, '⚠'),
-
-        # Compliance tier
-        'medication_adherence': ('MEDICATION ADHERENCE', body_style, '●'),
-        'safety_documentation': ('SAFETY DOCUMENTATION', alert_style, '⚠'),
-        'consent_issues': ('CONSENT ISSUES', warning_style, '⚠'),
-
-        # Expert witness tier
-        'contradictions': ('CONTRADICTIONS', warning_style, '⚠'),
-        'standard_of_care_deviations': ('STANDARD OF CARE DEVIATIONS', alert_style, '⚠'),
-        'competency_timeline': ('COMPETENCY TIMELINE', body_style, '●'),
-        'expert_opinions_needed': ('EXPERT OPINIONS NEEDED', body_style, '●'),
-
-        # Full discovery tier
-        'functional_capacity_timeline': ('FUNCTIONAL CAPACITY TIMELINE', body_style, '●'),
-        'suicide_violence_risk_assessment': ('SUICIDE/VIOLENCE RISK ASSESSMENT', alert_style, '⚠'),
-        'substance_use_impact': ('SUBSTANCE USE IMPACT', body_style, '●'),
-        'legal_psychiatric_interface': ('LEGAL-PSYCHIATRIC INTERFACE', body_style, '●'),
-        'causation_analysis': ('CAUSATION ANALYSIS', body_style, '●'),
-        'damages_assessment': ('DAMAGES ASSESSMENT', body_style, '●'),
-    }
-
     # Helper function to format structured objects for PDF
     def format_item_for_pdf(item):
         """Format structured objects (dicts) into readable text"""
@@ -288,29 +306,45 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
             # Plain string item
             return str(item)
 
-    for key, (title, style, icon) in critical_sections.items():
+    for key, (title, style, icon) in _CRITICAL_SECTIONS.items():
         if key in analysis and analysis[key]:
-            story.append(Paragraph(title, section_header_style))
+            story.append(Paragraph(title, SECTION_HEADER_STYLE))
             story.append(Spacer(1, 0.1*inch))
 
+            # Consecutive items that share a style go into one multi-line
+            # Paragraph; a comment or style change starts a new one.
+            lines = []
+            lines_style = style
+
+            def flush_lines():
+                if lines:
+                    story.append(Paragraph("<br/>".join(lines), lines_style))
+                    lines.clear()
+
             for i, item in enumerate(analysis[key]):
                 # Get appropriate icon and style based on change status
                 change_icon, change_style = get_icon_and_style(key, i, style, icon)
 
-                # Format item for display
-                formatted_item = format_item_for_pdf(item)
+                if change_style is not lines_style or len(lines) >= ITEMS_PER_PARAGRAPH:
+                    flush_lines()
+                    lines_style = change_style
+
+                # Format item for display (escaped: findings are plain text, not markup)
+                formatted_item = escape(format_item_for_pdf(item))
 
                 # Add the finding with change indicator
-                story.append(Paragraph(f"{change_icon} {i+1}. {formatted_item}", change_style))
+                lines.append(f"{change_icon} {i+1}. {formatted_item}")
 
                 # Add expert comment if exists (JSON stores indices as strings)
                 if comments and key in comments and str(i) in comments[key]:
-                    comment_text = comments[key][str(i)]
-                    story.append(Paragraph(f"💬 <i>Expert Note: {comment_text}</i>", comment_style))
+                    flush_lines()
+                    comment_text = escape(str(comments[key][str(i)]))
+                    story.append(Paragraph(f"💬 <i>Expert Note: {comment_text}</i>", COMMENT_STYLE))
 
+            flush_lines()
             story.append(Spacer(1, 0.2*inch))
 
-    # Note: Timeline is now handled in critical_sections above
+    # Note: Timeline is now handled in _CRITICAL_SECTIONS above
 
     # ===== FOOTER =====
     story.append(Spacer(1, 0.5*inch))
@@ -323,7 +357,7 @@ def generate_forensic_pdf(analysis, case_info, output_path, original_analysis=No
     </font>
     </para>
     """
-    story.append(Paragraph(footer_text, styles['Normal']))
+    story.append(Paragraph(footer_text, _STYLES['Normal']))
 
     # Build PDF
     doc.build(story)
@@ -17,6 +17,14 @@ Additional fields (pipeline-specific, not used by chronology assembly):
 - [Future pipelines can add custom fields as needed]
 
 This standard ensures engine.py can build chronologies without pipeline-specific logic.
+
+ANALYSIS PROMPTS:
+--------------------------------------------------------------------
+analysis_prompt templates put their static instructions first and the
+`{% for record in inputs %}` loop last. engine.py sends the text before the
+loop as a separate, prompt-cached block, so keep per-run content out of it.
+extraction_prompt templates likewise end with `Record: {{ input }}`, so every
+extraction call shares the same prefix and providers can cache it.
 """
 
 PIPELINE_CONFIGS = {
@@ -25,6 +33,9 @@ PIPELINE_CONFIGS = {
         "dataset_description": "medical and psychiatric records",
         "persona": "a forensic psychiatrist reviewing records for timeline construction",
         "extraction_model": "gpt-4o-mini",
+        # Low-complexity records. Only read by the litellm extraction backend (EXTRACTION_BACKEND=litellm);
+        # the default DocETL backend sends every record to extraction_model.
+        "extraction_model_simple": "gpt-4.1-nano",
         "analysis_model": "gpt-4o-mini",
         "requires_llm_analysis": False,  # Python builds timeline/gaps deterministically
         "num_retries_on_validate_failure": 2,  # Retry twice on validation failure
@@ -32,9 +43,7 @@ PIPELINE_CONFIGS = {
             'output["date"] != ""',       # Enforce date presence (critical for chronology)
             'output["record_id"] != ""'   # Enforce record_id for deduplication
         ],
-        "extraction_prompt": """Extract from this record:
-
-Record: {{ input }}
+        "extraction_prompt": """Extract from the record below:
 
 Return JSON with:
 - date: Record date (YYYY-MM-DD)
@@ -42,16 +51,19 @@ Return JSON with:
 - event_type: (evaluation, treatment, incident, hospitalization, medication_change, other)
 - event_description: One to two sentence description of what happened
 - provider: Provider name if mentioned
-""",
-        "analysis_prompt": """Create chronological timeline of psychiatric events:
 
-{% for record in inputs %}
-{{ record.date }}: [{{ record.event_type }}] {{ record.event_description }}
-{% endfor %}
+Record: {{ input }}
+""",
+        "analysis_prompt": """Create a chronological timeline of the psychiatric events in the records below.
 
 Return JSON with:
 - timeline: List of chronological events (include date at start of each)
 - treatment_gaps: Periods >30 days without documented care
+
+Records:
+{% for record in inputs %}
+{{ record.date }}: [{{ record.event_type }}] {{ record.event_description }}
+{% endfor %}
 """,
         "output_schema": {
             "date": "string",
@@ -72,9 +84,7 @@ Return JSON with:
         "persona": "a forensic psychiatrist preparing expert witness testimony",
         "extraction_model": "gpt-4o-mini",
         "analysis_model": "gpt-4o-mini",
-        "extraction_prompt": """Extract from this record:
-
-Record: {{ input }}
+        "extraction_prompt": """Extract from the record below:
 
 Return JSON with:
 - date: Record date
@@ -86,9 +96,21 @@ Return JSON with:
 - treatment_recommendations: Recommendations made
 - patient_statements: Relevant patient statements or behaviors
 - standard_of_care_issues: Potential deviations from standard care
+
+Record: {{ input }}
 """,
-        "analysis_prompt": """Prepare expert witness analysis:
+        "analysis_prompt": """Prepare an expert witness analysis of the records below.
+
+Return JSON with:
+- timeline: Chronological psychiatric timeline with dates
+- treatment_gaps: Missing care with record ID citations
+- medication_adherence: Medication compliance with citations
+- contradictions: Conflicting information across records with citations
+- standard_of_care_deviations: Care that deviates from accepted standards with citations
+- competency_timeline: Changes in patient competency over time
+- expert_opinions_needed: Areas requiring expert psychiatric interpretation
 
+Records:
 {% for record in inputs %}
 {{ record.date }} - {{ record.record_id }}:
 Provider: {{ record.provider }}
@@ -100,15 +122,6 @@ Patient Statements: {{ record.patient_statements }}
 Standard of Care: {{ record.standard_of_care_issues }}
 ---
 {% endfor %}
-
-Return JSON with:
-- timeline: Chronological psychiatric timeline with dates
-- treatment_gaps: Missing care with record ID citations
-- medication_adherence: Medication compliance with citations
-- contradictions: Conflicting information across records with citations
-- standard_of_care_deviations: Care that deviates from accepted standards with citations
-- competency_timeline: Changes in patient competency over time
-- expert_opinions_needed: Areas requiring expert psychiatric interpretation
 """,
         "output_schema": {
             "date": "string",
@@ -137,6 +150,9 @@ Return JSON with:
         "dataset_description": "medical records from various healthcare providers",
         "persona": "a medical chronologist extracting structured data from records",
         "extraction_model": "gpt-4o-mini",  # Model for extraction phase
+        # Low-complexity records, e.g. single lab results. Only read by the litellm extraction backend
+        # (EXTRACTION_BACKEND=litellm); the default DocETL backend sends every record to extraction_model.
+        "extraction_model_simple": "gpt-4.1-nano",
         "analysis_model": "gpt-4o-mini",  # Model for analysis phase (contradictions, red flags, expert opinions)
         "requires_llm_analysis": True,  # Needs LLM for contradictions, red flags, expert opinions
         "num_retries_on_validate_failure": 2,  # Retry twice on validation failure
@@ -144,9 +160,7 @@ Return JSON with:
             'output["date"] != ""',  # Enforce date presence (critical for chronology)
             'output["record_id"] != ""'  # Enforce record_id for de-duplication
         ],
-        "extraction_prompt": """Extract from this medical record:
-
-Record: {{ input }}
+        "extraction_prompt": """Extract from the medical record below:
 
 Return JSON with:
 - date: Record date (YYYY-MM-DD format)
@@ -156,6 +170,8 @@ Return JSON with:
 - event_description: One to two sentence summary of the event
 - diagnosis: Diagnosis mentioned (if any)
 - confidence: Confidence level (high, medium, or low)
+
+Record: {{ input }}
 """,
         "output_schema": {
             "date": "string",
@@ -166,16 +182,7 @@ Return JSON with:
             "diagnosis": "string",
             "confidence": "string"
         },
-        "analysis_prompt": """Perform forensic medical analysis on these records:
-
-{% for record in inputs %}
-{{ record.date }} - {{ record.record_id }}:
-Provider: {{ record.provider }}
-Event: [{{ record.event_type }}] {{ record.event_description }}
-Diagnosis: {{ record.diagnosis }}
-Confidence: {{ record.confidence }}
----
-{% endfor %}
+        "analysis_prompt": """Perform forensic medical analysis on the records below.
 
 Return JSON with:
 - contradictions: List of contradiction objects, each with:
@@ -197,6 +204,16 @@ Return JSON with:
   * records (list of strings): Relevant record IDs
 
 Note: Focus on medical-legal issues relevant to litigation, malpractice review, or expert witness testimony.
+
+Records:
+{% for record in inputs %}
+{{ record.date }} - {{ record.record_id }}:
+Provider: {{ record.provider }}
+Event: [{{ record.event_type }}] {{ record.event_description }}
+Diagnosis: {{ record.diagnosis }}
+Confidence: {{ record.confidence }}
+---
+{% endfor %}
 """,
         "analysis_schema": {
             "contradictions": "list[dict]",
@@ -0,0 +1,39 @@
+"""
+Shared setup for the backend tests.
+
+The backend modules import each other flat (import engine), as main.py runs them, so backend/
+is put on the path. Run from the repository root with: python -m pytest backend/tests
+"""
+
+import os
+import sys
+
+# Use LiteLLM's bundled model price map instead of downloading it at import
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import litellm
+import pytest
+
+import engine
+
+@pytest.fixture(autouse=True)
+def no_result_caches(monkeypatch):
+    """Tests make their LLM calls for real (against fakes) unless they turn a cache on themselves"""
+    monkeypatch.setattr(engine, "PIPELINE_CACHE_ENABLED", False)
+    monkeypatch.setattr(engine, "LLM_CACHE_ENABLED", False)
+
+@pytest.fixture
+def completion_response():
+    """Build a LiteLLM chat completion response carrying the given message content"""
+    def build(content, model="gpt-4o-mini", prompt_tokens=10, completion_tokens=5):
+        return litellm.ModelResponse(
+            model=model,
+            choices=[{"message": {"role": "assistant", "content": content}}],
+            usage={
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        )
+    return build
@@ -0,0 +1,85 @@
+"""Tests for per-run LLM cost tracking and the pipeline's cost aggregation"""
+
+import threading
+
+import orjson
+import pytest
+
+import engine
+
+def test_calls_for_unknown_runs_are_dropped():
+    engine.record_llm_usage(None, "chat", "gpt-4o-mini", {"total_tokens": 5}, 0.1)
+    engine.record_llm_usage("not-a-run", "extraction", "gpt-4o-mini", {"total_tokens": 5}, 0.1)
+
+    assert "not-a-run" not in engine._cost_tracker["runs"]
+
+def test_each_run_drains_only_its_own_calls():
+    run_ids = [engine.start_cost_run() for _ in range(4)]
+
+    def record(run_id, count):
+        for _ in range(count):
+            engine.record_llm_usage(run_id, "extraction", "gpt-4o-mini", {"total_tokens": 15}, 0.001)
+
+    threads = [threading.Thread(target=record, args=(run_id, 50 * (n + 1))) for n, run_id in enumerate(run_ids)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [len(engine.drain_cost_calls(run_id)) for run_id in run_ids] == [50, 100, 150, 200]
+    assert engine.drain_cost_calls(run_ids[0]) == []  # Draining removes the run
+
+def test_calls_are_priced_by_litellm(completion_response):
+    run_id = engine.start_cost_run()
+
+    engine.record_llm_call(run_id, "analysis", "gpt-4o-mini", completion_response("{}", prompt_tokens=1000))
+    engine.record_llm_call(run_id, "extraction", "openai/self-hosted",
+                           completion_response("{}", model="openai/self-hosted"))
+
+    priced, unpriced = engine.drain_cost_calls(run_id)
+    assert priced["cost"] > 0 and priced["total_tokens"] == 1005 and priced["operation"] == "analysis"
+    assert unpriced["cost"] == 0.0  # No price known: counted as free
+
+@pytest.fixture
+def fake_llm(monkeypatch, completion_response):
+    """Fake extraction and analysis calls (15 tokens each) for the litellm extraction backend"""
+    monkeypatch.setattr(engine, "EXTRACTION_BACKEND", "litellm")
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 1)
+
+    async def acompletion(model, messages, **kwargs):
+        record_id = messages[1]["content"].split("'id': '")[1].split("'")[0]
+        return completion_response(orjson.dumps({
+            "date": "2024-01-01", "record_id": record_id, "provider": "p", "event_type": "visit",
+            "event_description": "d", "diagnosis": "", "confidence": "high"
+        }).decode())
+
+    def completion(**kwargs):
+        return completion_response('{"red_flags": [], "contradictions": [], "expert_opinions_needed": []}')
+
+    monkeypatch.setattr(engine.litellm, "acompletion", acompletion)
+    monkeypatch.setattr(engine.litellm, "completion", completion)
+
+def test_pipeline_cost_data_adds_up_per_operation(fake_llm):
+    records = [{"id": f"MRN-{i}", "text": f"visit {i}"} for i in range(4)]
+
+    cost_data = engine.run_forensic_pipeline(records, pipeline="medical_chronology")["cost_data"]
+
+    assert cost_data["total_tokens"] == 5 * 15  # 4 extraction calls + 1 analysis call
+    assert cost_data["extraction_cost"] > 0 and cost_data["analysis_cost"] > 0
+    assert cost_data["total_cost"] == pytest.approx(cost_data["extraction_cost"] + cost_data["analysis_cost"])
+    # Short records are routed to the pipeline's extraction_model_simple
+    assert cost_data["extraction_cost_by_model"] == {"gpt-4.1-nano": pytest.approx(cost_data["extraction_cost"])}
+    assert engine._cost_tracker["runs"] == {}
+
+def test_failed_pipeline_reports_costs_so_far(fake_llm, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("assembly failed")
+
+    monkeypatch.setattr(engine, "parse_record_dates", fail)
+    records = [{"id": f"MRN-{i}", "text": f"visit {i}"} for i in range(3)]
+
+    result = engine.run_forensic_pipeline(records, pipeline="medical_chronology")
+
+    assert result["analysis"]["missing_records"] == ["Pipeline error: assembly failed"]
+    assert result["cost_data"]["total_tokens"] == 3 * 15
+    assert engine._cost_tracker["runs"] == {}
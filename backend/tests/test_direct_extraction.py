@@ -0,0 +1,218 @@
+"""Tests for the direct (LiteLLM) extraction backend: AIMD window, circuit breaker, batching, LLM cache"""
+
+import time
+
+import litellm
+import orjson
+import pytest
+
+import engine
+from pipeline_configs import get_pipeline_config
+
+PIPELINE = "psych_timeline"
+
+def extraction_reply(record_id, date="2024-01-01"):
+    return {"date": date, "record_id": record_id, "event_type": "visit", "event_description": "d", "provider": "p"}
+
+def record_ids_in(messages):
+    """MRN ids of the records a call's user prompt lists, in order"""
+    return [part.split("'")[0] for part in messages[1]["content"].split("'id': '")[1:]]
+
+def is_batched(kwargs):
+    return kwargs["response_format"]["json_schema"]["name"] == "extraction_batch"
+
+@pytest.fixture
+def fake_acompletion(monkeypatch, completion_response):
+    """
+    Install a fake litellm.acompletion that answers every record correctly, unless reply(ids, kwargs)
+    returns an exception to raise or a replacement message content. Returns the list of calls made.
+    """
+    calls = []
+
+    def install(reply=None):
+        async def acompletion(model, messages, **kwargs):
+            ids = record_ids_in(messages)
+            calls.append((ids, is_batched(kwargs)))
+            override = reply(ids, kwargs) if reply else None
+            if isinstance(override, Exception):
+                raise override
+            if override is not None:
+                return completion_response(override)
+            if is_batched(kwargs):
+                results = [{"index": n, **extraction_reply(record_id)} for n, record_id in enumerate(ids)]
+                return completion_response(orjson.dumps({"results": results}).decode())
+            return completion_response(orjson.dumps(extraction_reply(ids[0])).decode())
+
+        monkeypatch.setattr(engine.litellm, "acompletion", acompletion)
+        return calls
+
+    return install
+
+def extract(records, **config_overrides):
+    pipeline_config = {**get_pipeline_config(PIPELINE), **config_overrides}
+    return engine.extract_records_direct(records, pipeline_config, "gpt-4o-mini")
+
+# ============= Size bins =============
+
+@pytest.mark.parametrize("prompt_chars, expected_bin", [
+    (0, 0), (4_000, 0), (4_004, 1), (16_000, 1), (64_000, 2), (64_004, 3), (10_000_000, 3)
+])
+def test_prompts_are_binned_by_estimated_tokens(prompt_chars, expected_bin):
+    assert engine._extraction_bin(prompt_chars) == expected_bin
+
+# ============= AIMD window and circuit breaker =============
+
+def provider_error(status_code):
+    error = litellm.InternalServerError("upstream failed", llm_provider="openai", model="gpt-4o-mini")
+    error.status_code = status_code
+    return error
+
+def test_throttling_halves_the_window_once_per_round():
+    call_window = engine.new_call_window(16)
+    started = time.monotonic()
+
+    engine._record_call_outcome(call_window, provider_error(429), started)
+    engine._record_call_outcome(call_window, provider_error(429), started)  # Same round: no second cut
+
+    assert call_window["window"] == 8
+    engine._record_call_outcome(call_window, provider_error(429), time.monotonic())
+    assert call_window["window"] == 4
+
+def test_successes_grow_the_window_up_to_its_maximum():
+    call_window = engine.new_call_window(4)
+    call_window["window"] = 2.0
+
+    engine._record_call_outcome(call_window, object(), time.monotonic())
+    assert call_window["window"] == 2.5
+    for _ in range(20):
+        engine._record_call_outcome(call_window, object(), time.monotonic())
+    assert call_window["window"] == 4
+
+def test_retry_after_is_read_and_capped():
+    error = provider_error(429)
+    error.litellm_response_headers = {"retry-after": "2"}
+    assert engine._retry_after_seconds(error) == 2
+    error.litellm_response_headers = {"retry-after": "3600"}
+    assert engine._retry_after_seconds(error) == engine.MAX_RETRY_AFTER_SECONDS
+    assert engine._retry_after_seconds(provider_error(500)) is None
+
+def test_breaker_trips_after_consecutive_provider_failures(monkeypatch):
+    monkeypatch.setattr(engine, "EXTRACTION_BREAKER_THRESHOLD", 3)
+    call_window = engine.new_call_window(8)
+
+    for _ in range(2):
+        engine._record_call_outcome(call_window, provider_error(500), time.monotonic())
+    assert call_window["open_until"] == 0.0
+    engine._record_call_outcome(call_window, object(), time.monotonic())  # A success resets the count
+    for _ in range(3):
+        engine._record_call_outcome(call_window, provider_error(502), time.monotonic())
+
+    assert call_window["open_until"] > time.monotonic()
+
+def test_client_errors_do_not_trip_the_breaker(monkeypatch):
+    monkeypatch.setattr(engine, "EXTRACTION_BREAKER_THRESHOLD", 2)
+    call_window = engine.new_call_window(8)
+
+    for _ in range(5):
+        engine._record_call_outcome(call_window, provider_error(400), time.monotonic())
+
+    assert call_window["open_until"] == 0.0
+
+def test_extraction_recovers_once_the_breaker_closes(monkeypatch, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(engine, "EXTRACTION_BREAKER_SECONDS", 0.3)
+    failures = [provider_error(503), provider_error(500)]
+    calls = fake_acompletion(lambda ids, kwargs: failures.pop(0) if failures else None)
+
+    started = time.monotonic()
+    extracted, _ = extract([{"id": "MRN-1", "text": "visit"}])
+
+    assert [record["record_id"] for record in extracted] == ["MRN-1"]
+    assert len(calls) == 3
+    # The third attempt waited for the breaker to close
+    assert time.monotonic() - started >= 0.3
+
+def test_calls_fail_fast_while_the_breaker_is_open(monkeypatch, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 1)
+    calls = fake_acompletion()
+    call_window = engine.new_call_window(8)
+    call_window["open_until"] = time.monotonic() + 60
+    monkeypatch.setattr(engine, "new_call_window", lambda max_in_flight: call_window)
+
+    extracted, _ = extract([{"id": "MRN-1", "text": "visit"}], num_retries_on_validate_failure=0)
+
+    assert extracted == []
+    assert calls == []
+
+# ============= Batched short records =============
+
+def test_short_records_share_batched_calls(monkeypatch, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 10)
+    calls = fake_acompletion()
+    records = [{"id": f"MRN-{i}", "text": "visit"} for i in range(4)]
+
+    extracted, _ = extract(records)
+
+    assert [record["record_id"] for record in extracted] == [f"MRN-{i}" for i in range(4)]
+    assert calls == [([f"MRN-{i}" for i in range(4)], True)]
+
+def test_mismatched_batch_results_fall_back_to_one_call_per_record(monkeypatch, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 10)
+
+    def swap_first_two(ids, kwargs):
+        if not is_batched(kwargs):
+            return None
+        results = [{"index": n, **extraction_reply(record_id, date=f"2024-01-0{n + 1}")} for n, record_id in enumerate(ids)]
+        results[0]["record_id"], results[1]["record_id"] = results[1]["record_id"], results[0]["record_id"]
+        return orjson.dumps({"results": results}).decode()
+
+    calls = fake_acompletion(swap_first_two)
+    records = [{"id": f"MRN-{i}", "text": "visit"} for i in range(4)]
+
+    extracted, _ = extract(records)
+
+    assert [record["record_id"] for record in extracted] == ["MRN-0", "MRN-1", "MRN-2", "MRN-3"]
+    assert [record["id"] for record in extracted] == [record["record_id"] for record in extracted]
+    assert sorted(call for call in calls if not call[1]) == [(["MRN-0"], False), (["MRN-1"], False)]
+
+def test_unparseable_batch_reply_falls_back_for_every_record(monkeypatch, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 10)
+    calls = fake_acompletion(lambda ids, kwargs: '{"results": [' if is_batched(kwargs) else None)
+    records = [{"id": f"MRN-{i}", "text": "visit"} for i in range(3)]
+
+    extracted, _ = extract(records)
+
+    assert len(extracted) == 3
+    assert sum(not batched for _, batched in calls) == 3
+
+# ============= LLM response cache =============
+
+@pytest.fixture
+def llm_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(engine, "LLM_CACHE_ENABLED", True)
+    monkeypatch.setattr(engine, "PIPELINE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(engine, "LLM_CACHE_PATH", str(tmp_path / "llm_responses.sqlite3"))
+    monkeypatch.setattr(engine, "_llm_cache", {"lock": engine._llm_cache["lock"], "db": None})
+
+def test_cache_hit_skips_the_call(monkeypatch, llm_cache, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 1)
+    calls = fake_acompletion()
+    records = [{"id": f"MRN-{i}", "text": "visit"} for i in range(2)]
+
+    first, first_hits = extract(records)
+    second, second_hits = extract(records + [{"id": "MRN-9", "text": "visit"}])
+
+    assert (first_hits, second_hits) == (0, 2)
+    assert [ids for ids, _ in calls[2:]] == [["MRN-9"]]  # Only the new record was sent
+    assert second[:2] == first
+
+def test_batched_results_are_not_cached(monkeypatch, llm_cache, fake_acompletion):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 10)
+    calls = fake_acompletion()
+    records = [{"id": f"MRN-{i}", "text": "visit"} for i in range(3)]
+
+    extract(records)
+    _, cache_hits = extract(records)
+
+    assert cache_hits == 0
+    assert len(calls) == 2
@@ -0,0 +1,91 @@
+"""Tests for running large DocETL extractions as parallel runner shards"""
+
+import time
+
+import pytest
+
+import engine
+
+class FakeRunner:
+    """Stands in for DSLRunner: echoes the in-memory dataset back as extracted rows"""
+    configs = []
+
+    def __init__(self, config, max_threads, timeout_seconds):
+        self.config = config
+        self.total_cost = 0.01
+        self.total_token_usage = {"gpt-4o-mini": {"prompt_tokens": 100, "completion_tokens": 20}}
+        FakeRunner.configs.append(config)
+
+    def run(self):
+        records = self.config["datasets"]["records"]["path"]
+        return [{**record, "date": "2024-01-01"} for record in records], self.total_cost
+
+@pytest.fixture
+def fake_runner(monkeypatch):
+    FakeRunner.configs = []
+    monkeypatch.setattr(engine, "DSLRunner", FakeRunner)
+    engine.docetl_config_template.cache_clear()
+    yield FakeRunner
+    engine.docetl_config_template.cache_clear()
+
+def test_small_record_set_runs_as_a_single_shard(fake_runner):
+    records = [{"id": f"MRN-{i}"} for i in range(5)]
+
+    extracted = engine.run_docetl_extraction(records, "psych_timeline")
+
+    assert [record["id"] for record in extracted] == [record["id"] for record in records]
+    assert len(fake_runner.configs) == 1
+
+def test_large_record_set_is_split_into_shards_and_keeps_input_order(monkeypatch):
+    monkeypatch.setattr(engine, "DOCETL_SHARD_SIZE", 3)
+    shards = []
+
+    def fake_shard(records, pipeline, shard_index=None, run_id=None):
+        shards.append((shard_index, [record["id"] for record in records]))
+        time.sleep(0.01 * (4 - shard_index))  # Later shards finish first
+        return [{**record, "shard": shard_index} for record in records]
+
+    monkeypatch.setattr(engine, "_run_docetl_shard", fake_shard)
+    records = [{"id": i} for i in range(10)]
+
+    extracted = engine.run_docetl_extraction(records, "psych_timeline")
+
+    assert [record["id"] for record in extracted] == list(range(10))
+    assert sorted(shards) == [(0, [0, 1, 2]), (1, [3, 4, 5]), (2, [6, 7, 8]), (3, [9])]
+
+def test_shard_count_is_capped(monkeypatch):
+    monkeypatch.setattr(engine, "DOCETL_SHARD_SIZE", 2)
+    monkeypatch.setattr(engine, "DOCETL_MAX_SHARDS", 2)
+    shard_sizes = []
+
+    def fake_shard(records, pipeline, shard_index=None, run_id=None):
+        shard_sizes.append(len(records))
+        return records
+
+    monkeypatch.setattr(engine, "_run_docetl_shard", fake_shard)
+
+    engine.run_docetl_extraction([{"id": i} for i in range(10)], "psych_timeline")
+
+    assert shard_sizes == [5, 5]
+
+def test_shards_get_separate_intermediate_dirs(fake_runner, monkeypatch, tmp_path):
+    monkeypatch.setattr(engine, "DOCETL_INTERMEDIATE_DIR", str(tmp_path))
+    monkeypatch.setattr(engine, "DOCETL_SHARD_SIZE", 2)
+
+    engine.run_docetl_extraction([{"id": i} for i in range(4)], "psych_timeline")
+
+    dirs = sorted(config["pipeline"]["output"]["intermediate_dir"] for config in fake_runner.configs)
+    assert dirs == [str(tmp_path / "shard_0"), str(tmp_path / "shard_1")]
+    # The shared template is left untouched
+    assert "datasets" not in engine.docetl_config_template("psych_timeline")
+
+def test_each_shard_records_its_runner_totals(fake_runner, monkeypatch):
+    monkeypatch.setattr(engine, "DOCETL_SHARD_SIZE", 2)
+    run_id = engine.start_cost_run()
+
+    engine.run_docetl_extraction([{"id": i} for i in range(4)], "psych_timeline", run_id)
+
+    calls = engine.drain_cost_calls(run_id)
+    assert len(calls) == 2
+    assert all(call["operation"] == "extraction" and call["total_tokens"] == 120 for call in calls)
+    assert sum(call["cost"] for call in calls) == pytest.approx(0.02)
@@ -0,0 +1,113 @@
+"""Tests for strict-schema extraction replies and the JSON scanning fallback"""
+
+import orjson
+import pytest
+
+import engine
+from pipeline_configs import get_pipeline_config
+
+VALIDATION_RULES = ['output["date"] != ""', 'output["record_id"] != ""']
+
+# ============= extract_json_object =============
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', '{"a": 1}'),
+    ('```json\n{"a": 1}\n```', '{"a": 1}'),
+    ('Here is the analysis: {"a": {"b": [1, 2]}} Let me know.', '{"a": {"b": [1, 2]}}'),
+    ('{"a": "}"} {"b": 2}', '{"a": "}"}'),
+    ('{"a": "say \\"}\\" twice"}', '{"a": "say \\"}\\" twice"}'),
+    ('{"a": "back\\\\"} tail', '{"a": "back\\\\"}'),
+])
+def test_extract_json_object_finds_the_first_balanced_object(text, expected):
+    assert engine.extract_json_object(text) == expected
+    orjson.loads(engine.extract_json_object(text))
+
+@pytest.mark.parametrize("text, expected", [
+    ("no json here", "no json here"),
+    ("", ""),
+    ('prefix {"a": [1, 2', '{"a": [1, 2'),
+    ('{"a": "unterminated}', '{"a": "unterminated}'),
+])
+def test_extract_json_object_leaves_malformed_input_for_orjson_to_reject(text, expected):
+    assert engine.extract_json_object(text) == expected
+    with pytest.raises(orjson.JSONDecodeError):
+        orjson.loads(engine.extract_json_object(text))
+
+def test_analysis_parses_a_fenced_reply(monkeypatch, completion_response):
+    reply = 'Sure:\n```json\n{"red_flags": [], "contradictions": [], "expert_opinions_needed": []}\n```'
+    monkeypatch.setattr(engine.litellm, "completion", lambda **kwargs: completion_response(reply))
+    records = [{"date": "2024-01-01", "record_id": "R1", "event_type": "visit", "event_description": "d", "provider": "p"}]
+
+    result = engine.analyze_records_for_red_flags(records, "gpt-4o-mini", get_pipeline_config("medical_chronology"))
+
+    assert result == {"red_flags": [], "contradictions": [], "expert_opinions_needed": []}
+
+def test_analysis_returns_none_for_an_unparseable_reply(monkeypatch, completion_response):
+    monkeypatch.setattr(engine.litellm, "completion", lambda **kwargs: completion_response('{"red_flags": ['))
+    records = [{"date": "2024-01-01", "record_id": "R1", "event_type": "visit", "event_description": "d", "provider": "p"}]
+
+    assert engine.analyze_records_for_red_flags(records, "gpt-4o-mini", get_pipeline_config("medical_chronology")) is None
+
+# ============= Extraction replies =============
+
+def test_response_format_is_strict_and_requires_every_field():
+    response_format = engine.extraction_response_format({"date": "string", "codes": "list[str]", "score": "float"})
+
+    schema = response_format["json_schema"]["schema"]
+    assert response_format["json_schema"]["strict"] is True
+    assert schema["required"] == ["date", "codes", "score"]
+    assert schema["additionalProperties"] is False
+    assert schema["properties"]["codes"] == {"type": "array", "items": {"type": "string"}}
+    assert schema["properties"]["score"] == {"type": "number"}
+
+def test_batch_response_format_wraps_indexed_results():
+    response_format = engine.extraction_response_format({"date": "string"}, batch=True)
+
+    item_schema = response_format["json_schema"]["schema"]["properties"]["results"]["items"]
+    assert response_format["json_schema"]["name"] == "extraction_batch"
+    assert item_schema["required"] == ["index", "date"]
+
+def test_unsupported_schema_type_is_rejected():
+    with pytest.raises(ValueError):
+        engine.extraction_response_format({"date": "datetime"})
+
+@pytest.mark.parametrize("content", [
+    None,
+    "",
+    "not json",
+    '["date", "2024-01-01"]',
+    '{"date": "", "record_id": "R1"}',
+    '{"date": "2024-01-01"}',
+])
+def test_invalid_extraction_replies_are_rejected(content):
+    assert engine._parse_extraction_content(content, VALIDATION_RULES) is None
+
+def test_valid_extraction_reply_is_returned():
+    output = engine._parse_extraction_content('{"date": "2024-01-01", "record_id": "R1"}', VALIDATION_RULES)
+
+    assert output == {"date": "2024-01-01", "record_id": "R1"}
+
+def test_failed_validation_is_retried_then_the_record_is_skipped(monkeypatch, completion_response):
+    monkeypatch.setattr(engine, "EXTRACTION_BATCH_SIZE", 1)
+    replies = {
+        "MRN-1": ['{"date": "", "record_id": "MRN-1", "event_type": "", "event_description": "", "provider": ""}',
+                  '{"date": "2024-01-01", "record_id": "MRN-1", "event_type": "", "event_description": "", "provider": ""}'],
+        "MRN-2": ['{"date": "", "record_id": "MRN-2", "event_type": "", "event_description": "", "provider": ""}'] * 3
+    }
+    calls = []
+
+    async def acompletion(model, messages, **kwargs):
+        record_id = "MRN-1" if "MRN-1" in messages[1]["content"] else "MRN-2"
+        calls.append(record_id)
+        return completion_response(replies[record_id].pop(0))
+
+    monkeypatch.setattr(engine.litellm, "acompletion", acompletion)
+    records = [{"id": "MRN-1", "text": "visit"}, {"id": "MRN-2", "text": "visit"}]
+
+    extracted, cache_hits = engine.extract_records_direct(records, get_pipeline_config("psych_timeline"), "gpt-4o-mini")
+
+    assert [record["record_id"] for record in extracted] == ["MRN-1"]
+    assert extracted[0]["text"] == "visit"  # Input fields pass through
+    assert calls.count("MRN-1") == 2
+    assert calls.count("MRN-2") == 3  # num_retries_on_validate_failure=2
+    assert cache_hits == 0